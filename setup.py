@@ -38,7 +38,13 @@ setup(
     packages=find_packages(include=['stathakis']),
     entry_points={
         'console_scripts': [
-            'stathakis=stathakis.cli:main'
+            'stathakis=stathakis.cli:main',
+            'stathakis-cache=stathakis.cli:build_cache'
+        ],
+        # shared cache backends, see stathakis.cache
+        'beaker.backends': [
+            'stathakis.redis=stathakis.cache:RedisNamespaceManager',
+            'stathakis.lmdb=stathakis.cache:LmdbNamespaceManager'
         ]
     },
     scripts=[
@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+
+"""Asyncio server for the station endpoints, which wait on the upstream services.
+
+The station endpoints are coroutines that use an asyncio HTTP client, so
+one worker can wait on many upstream requests. Parsing, encoding and the
+local store run in the default executor of the loop. All other endpoints,
+including the CPU-bound grid endpoints, are served by the flask app in a
+thread pool.
+"""
+import asyncio
+import concurrent.futures
+import functools
+import logging
+import re
+
+import aiohttp
+import aiohttp.web
+import aiohttp_wsgi
+import dateutil.parser
+import werkzeug.datastructures
+import werkzeug.http
+
+from .http_cache import (
+    body_etag,
+    cache_headers,
+    has_measurements,
+    is_modified,
+    make_etag,
+    recent_max_age,
+    window_policy
+)
+from .measurements import (
+    available_async_station_measurements,
+    available_station_infos,
+    available_station_versions,
+    available_stations_per_quantity
+)
+from .measurements.catalogue import UnknownQuantityException
+from .responses import best_series_format, dumps, series_formats
+from .upstream import STATUS_FORCELIST, client_settings
+
+logger = logging.getLogger(__name__)
+
+# basePath of swagger.yaml
+BASE_PATH = '/stathakis/1.0.0'
+# like flask_cors for the flask app
+CORS_HEADERS = {'Access-Control-Allow-Origin': '*'}
+
+
+class AsyncUpstreamClient(object):
+    """Pooled asyncio HTTP session for an upstream service.
+
+    The asyncio version of stathakis.upstream.UpstreamClient, with the same
+    settings. Open it in the loop that uses it. At most `max_concurrent`
+    requests are sent at the same time, the other requests wait without
+    holding a thread.
+    """
+
+    def __init__(
+            self,
+            pool_size=10,
+            max_concurrent=4,
+            connect_timeout=10,
+            read_timeout=60,
+            retries=3,
+            backoff_factor=0.5
+    ):
+        self.pool_size = pool_size
+        self.max_concurrent = max_concurrent
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.session = None
+        self.slots = None
+
+    @classmethod
+    def from_config(cls, config, prefix):
+        """create a client from the settings that start with prefix (DDL_POOL_SIZE, ...)"""
+        return cls(**client_settings(config, prefix))
+
+    async def open(self):
+        timeout = aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=self.read_timeout)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.pool_size),
+            headers={'Accept-Encoding': 'gzip, deflate'},
+            timeout=timeout
+        )
+        self.slots = asyncio.Semaphore(self.max_concurrent)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def post(self, url, **kwargs):
+        """post a request and return the response body
+
+        Connection errors, timeouts and server errors are retried with
+        exponential backoff.
+        """
+        for attempt in range(self.retries + 1):
+            last = attempt == self.retries
+            try:
+                async with self.slots:
+                    async with self.session.post(url, **kwargs) as resp:
+                        if resp.status not in STATUS_FORCELIST or last:
+                            resp.raise_for_status()
+                            return await resp.read()
+                        logger.warning("%s returned %s, retrying", url, resp.status)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if last:
+                    raise
+                logger.warning("request to %s failed, retrying", url, exc_info=True)
+            await asyncio.sleep(self.backoff_factor * 2 ** attempt)
+
+
+def run_in_executor(fun, *args, **kwargs):
+    """run fun in the default executor of the loop"""
+    loop = asyncio.get_event_loop()
+    return loop.run_in_executor(None, functools.partial(fun, *args, **kwargs))
+
+
+def max_age(request):
+    return request.app['config'].get('HTTP_MAX_AGE', 3600)
+
+
+def not_modified(headers):
+    """return an empty 304 response with the caching headers"""
+    headers = dict(headers, **CORS_HEADERS)
+    return aiohttp.web.Response(status=304, headers=headers)
+
+
+def floats(value):
+    """parse a csv query parameter as a list of floats"""
+    if value is None:
+        return None
+    return [float(x) for x in value.split(',')]
+
+
+def parse_time(value):
+    """parse an optional date-time query parameter"""
+    if value is None:
+        return None
+    return dateutil.parser.parse(value)
+
+
+async def stations_per_quantity(request):
+    """return a list of all stations, optionally within bbox or nearest to near"""
+    dataset = request.match_info['dataset']
+    quantity = request.match_info['quantity']
+    try:
+        bbox = floats(request.query.get('bbox'))
+        near = floats(request.query.get('near'))
+        k = int(request.query.get('k', 5))
+    except ValueError as e:
+        raise aiohttp.web.HTTPBadRequest(text=str(e))
+    # validated by swagger in the flask app
+    if bbox is not None and len(bbox) != 4:
+        raise aiohttp.web.HTTPBadRequest(text="bbox should be lon_min,lat_min,lon_max,lat_max")
+    if near is not None and len(near) != 2:
+        raise aiohttp.web.HTTPBadRequest(text="near should be lon,lat")
+    if k < 1:
+        raise aiohttp.web.HTTPBadRequest(text="k should be at least 1")
+    fun = available_stations_per_quantity[dataset]
+    version, modified = await run_in_executor(available_station_versions[dataset])
+    etag = make_etag(dataset, version, quantity, bbox, near, k)
+    headers = cache_headers(etag, last_modified=modified, max_age=max_age(request))
+    if not is_modified(request.headers, etag, modified):
+        return not_modified(headers)
+    try:
+        feature_collection = await run_in_executor(fun, quantity, bbox=bbox, near=near, k=k)
+    except UnknownQuantityException:
+        raise aiohttp.web.HTTPBadRequest(text="unknown quantity %s" % (quantity, ))
+    body = await run_in_executor(dumps, feature_collection)
+    headers.update(CORS_HEADERS)
+    return aiohttp.web.Response(body=body, content_type='application/json', headers=headers)
+
+
+async def station_info(request):
+    dataset = request.match_info['dataset']
+    id = request.match_info['id']
+    fun = available_station_infos[dataset]
+    version, modified = await run_in_executor(available_station_versions[dataset])
+    etag = make_etag(dataset, version, id)
+    headers = cache_headers(etag, last_modified=modified, max_age=max_age(request))
+    if not is_modified(request.headers, etag, modified):
+        return not_modified(headers)
+    station_info = await run_in_executor(fun, id)
+    body = await run_in_executor(dumps, station_info)
+    headers.update(CORS_HEADERS)
+    return aiohttp.web.Response(body=body, content_type='application/json', headers=headers)
+
+
+async def station_measurements(request):
+    """return measurements for a quantity, in the format of the format parameter or the Accept header"""
+    dataset = request.match_info['dataset']
+    quantity = request.match_info['quantity']
+    try:
+        start_time = parse_time(request.query.get('start_time'))
+        end_time = parse_time(request.query.get('end_time'))
+    except (ValueError, OverflowError) as e:
+        raise aiohttp.web.HTTPBadRequest(text=str(e))
+    format = request.query.get('format')
+    if format is None:
+        accept = werkzeug.http.parse_accept_header(
+            request.headers.get('Accept'),
+            werkzeug.datastructures.MIMEAccept
+        )
+        format = best_series_format(accept)
+    if format not in series_formats:
+        raise aiohttp.web.HTTPNotAcceptable(text="unknown format %s" % (format, ))
+
+    config = request.app['config']
+    age, immutable = window_policy(end_time, config)
+    # past windows with data are identified by the request, others by their body
+    etag = None
+    if immutable:
+        etag = make_etag(dataset, request.match_info['id'], quantity, start_time, end_time, format)
+        if not is_modified(request.headers, etag):
+            return not_modified(cache_headers(etag, max_age=age, immutable=True, vary='Accept'))
+
+    fun = available_async_station_measurements[dataset]
+    try:
+        station_data = await fun(
+            request.app['ddl_client'],
+            request.match_info['id'],
+            quantity,
+            start_time=start_time,
+            end_time=end_time
+        )
+    except UnknownQuantityException:
+        raise aiohttp.web.HTTPBadRequest(text="unknown quantity %s" % (quantity, ))
+    if immutable and not has_measurements(station_data):
+        # might be a temporary failure upstream, check again soon
+        etag, age, immutable = None, recent_max_age(config), False
+    encode, mimetype = series_formats[format]
+    try:
+        body = await run_in_executor(encode, station_data)
+    except ImportError:
+        logger.exception("format %s is not available", format)
+        raise aiohttp.web.HTTPNotAcceptable(text="format %s is not available" % (format, ))
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    if etag is None:
+        etag = body_etag(body)
+    headers = cache_headers(etag, max_age=age, immutable=immutable, vary='Accept')
+    if not is_modified(request.headers, etag):
+        return not_modified(headers)
+    headers.update(CORS_HEADERS)
+    return aiohttp.web.Response(body=body, content_type=mimetype, headers=headers)
+
+
+async def open_clients(aio_app):
+    """open the upstream clients in the loop of the app"""
+    aio_app['ddl_client'] = AsyncUpstreamClient.from_config(aio_app['config'], 'DDL_')
+    await aio_app['ddl_client'].open()
+
+
+async def close_clients(aio_app):
+    await aio_app['ddl_client'].close()
+
+
+def datasets(keys):
+    """return a route pattern that matches the datasets in keys"""
+    return '{dataset:%s}' % ('|'.join(re.escape(key) for key in keys), )
+
+
+def make_aio_app(app, threads=4):
+    """return an aiohttp app for the connexion app
+
+    The station endpoints of the datasets with an asyncio implementation
+    are served by coroutines, other requests are passed to the flask app,
+    which runs in a pool of `threads` threads.
+    """
+    flask_app = app.app
+    aio_app = aiohttp.web.Application()
+    aio_app['config'] = flask_app.config
+    aio_app.on_startup.append(open_clients)
+    aio_app.on_cleanup.append(close_clients)
+    stations = BASE_PATH + '/stations/'
+    aio_app.router.add_get(
+        stations + datasets(available_station_infos) + '/{id}/info',
+        station_info
+    )
+    aio_app.router.add_get(
+        stations + datasets(available_async_station_measurements) + '/{id}/measurements/{quantity}',
+        station_measurements
+    )
+    aio_app.router.add_get(
+        stations + datasets(available_stations_per_quantity) + '/{quantity}',
+        stations_per_quantity
+    )
+    wsgi_handler = aiohttp_wsgi.WSGIHandler(
+        flask_app,
+        executor=concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+    )
+    aio_app.router.add_route('*', '/{path_info:.*}', wsgi_handler)
+    return aio_app
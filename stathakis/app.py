@@ -1,12 +1,35 @@
 #!/usr/bin/env python3
+import logging
 
 import connexion
 import flask_cors
 
+from .measurements import available_grid_stores, configure
 
-def make_app():
+logger = logging.getLogger(__name__)
+
+
+def open_grid_stores(config):
+    """open the grid files at startup, so requests can reuse them"""
+    for id, open_store in available_grid_stores.items():
+        data_dir = config["%s_DATA_DIR" % (id.upper(), )]
+        try:
+            open_store(data_dir)
+        except (IOError, OSError, ValueError):
+            logger.exception("could not open grid %s in %s", id, data_dir)
+
+
+def make_app(start_threads=True):
+    """return the connexion app, see stathakis.measurements.configure for start_threads"""
     app = connexion.App(__name__, specification_dir='./swagger/')
     app.add_api('swagger.yaml', arguments={'title': 'This API allows you to retrieve realtime and historic measurements. It is a frontend for measurements from other sources. It is intended for stations or gridded timeseries.'})
     # add CORS to the app, should not have any secure api's
     flask_cors.CORS(app.app)
+    # load configuration (connexxion app contains flask app)
+    app.app.config.from_object('stathakis.config')
+    configured = app.app.config.from_envvar('STATHAKIS_SETTINGS', silent=True)
+    if not configured:
+        logger.debug("configuration file not found. Use STATHAKIS_SETTINGS to point to config file.")
+    configure(app.app.config, start_threads=start_threads)
+    open_grid_stores(app.app.config)
     return app
@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+
+"""Shared backends for the beaker cache regions.
+
+The `memory` backend of beaker keeps a cache per worker process. These
+backends share the cache between processes: `stathakis.lmdb` in an LMDB
+database on the host, `stathakis.redis` in a redis compatible key-value
+server that all replicas use. They are registered as beaker backends in
+setup.py, see region_settings for the configuration.
+
+Cached values are not pickled. Data frames are encoded as Arrow IPC
+streams and the rest of the value as JSON, so tuples are read back as
+lists.
+"""
+import datetime
+import hashlib
+import json
+import logging
+import os
+import struct
+import time
+
+import numpy as np
+import pandas as pd
+from beaker.container import NamespaceManager
+from beaker.synchronization import NameLock
+
+logger = logging.getLogger(__name__)
+
+# start of an encoded value, followed by the length of the JSON part
+MAGIC = b'STC1'
+HEADER = struct.Struct('<4sI')
+FRAME_LENGTH = struct.Struct('<Q')
+# expiry time in front of the lmdb values, 0 for never
+EXPIRES = struct.Struct('<d')
+# keys are hashed above this length (the lmdb limit is 511 bytes)
+MAX_KEY_LENGTH = 250
+
+
+def dumps(value):
+    """encode a value of dicts, lists, scalars, datetimes and data frames as bytes"""
+    import pyarrow
+    frames = []
+
+    def default(obj):
+        if isinstance(obj, pd.DataFrame):
+            frames.append(obj)
+            return {"__frame__": len(frames) - 1}
+        if isinstance(obj, datetime.datetime):
+            return {"__datetime__": obj.isoformat()}
+        if isinstance(obj, np.generic):
+            return obj.item()
+        if isinstance(obj, np.ndarray):
+            return obj.tolist()
+        raise TypeError("%r can not be cached" % (obj, ))
+
+    encoded = json.dumps(value, default=default, separators=(',', ':')).encode('utf-8')
+    parts = [HEADER.pack(MAGIC, len(encoded)), encoded]
+    for frame in frames:
+        table = pyarrow.Table.from_pandas(frame)
+        sink = pyarrow.BufferOutputStream()
+        writer = pyarrow.RecordBatchStreamWriter(sink, table.schema)
+        writer.write_table(table)
+        writer.close()
+        buffer = sink.getvalue().to_pybytes()
+        parts.append(FRAME_LENGTH.pack(len(buffer)))
+        parts.append(buffer)
+    return b''.join(parts)
+
+
+def loads(data):
+    """decode a value encoded by dumps"""
+    import pyarrow
+    data = memoryview(data)
+    magic, length = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("not a cached value")
+    offset = HEADER.size + length
+    frames = []
+    while offset < len(data):
+        (frame_length, ) = FRAME_LENGTH.unpack_from(data, offset)
+        offset += FRAME_LENGTH.size
+        reader = pyarrow.RecordBatchStreamReader(pyarrow.py_buffer(data[offset:offset + frame_length]))
+        frames.append(reader.read_all().to_pandas())
+        offset += frame_length
+
+    def object_hook(obj):
+        if len(obj) == 1:
+            if "__frame__" in obj:
+                return frames[obj["__frame__"]]
+            if "__datetime__" in obj:
+                return pd.Timestamp(obj["__datetime__"])
+        return obj
+
+    return json.loads(bytes(data[HEADER.size:HEADER.size + length]).decode('utf-8'), object_hook=object_hook)
+
+
+def format_key(namespace, key):
+    """return the storage key of a beaker key, long keys are hashed"""
+    if isinstance(key, bytes):
+        key = key.decode('utf-8')
+    key = '%s:%s' % (namespace, key)
+    if len(key) > MAX_KEY_LENGTH:
+        key = '%s:%s' % (namespace, hashlib.sha1(key.encode('utf-8')).hexdigest())
+    return key
+
+
+class SharedNamespaceManager(NamespaceManager):
+    """Beaker namespace in a store that is shared between processes.
+
+    Values are created once per process at a time, requests that need the
+    value of the same key wait for it. Other processes might create it at
+    the same time.
+    """
+
+    def get_creation_lock(self, key):
+        return NameLock(
+            identifier="stathakis/funclock/%s/%s" % (self.namespace, key),
+            reentrant=True
+        )
+
+    def has_key(self, key):
+        return key in self
+
+    def __setitem__(self, key, value):
+        self.set_value(key, value)
+
+
+class RedisNamespaceManager(SharedNamespaceManager):
+    """Beaker namespace in a redis compatible key-value server at url.
+
+    The server removes the entries after the expire time of the region.
+    """
+
+    # one client per url, the connections are reopened after a fork
+    clients = {}
+
+    def __init__(self, namespace, url='redis://localhost:6379/0', **kwargs):
+        super(RedisNamespaceManager, self).__init__(namespace)
+        import redis
+        client = self.clients.get(url)
+        if client is None:
+            client = self.clients.setdefault(url, redis.StrictRedis.from_url(url))
+        self.client = client
+        self.prefix = 'stathakis:'
+
+    def key(self, key):
+        return self.prefix + format_key(self.namespace, key)
+
+    def __getitem__(self, key):
+        data = self.client.get(self.key(key))
+        if data is None:
+            raise KeyError(key)
+        return loads(data)
+
+    def __contains__(self, key):
+        return bool(self.client.exists(self.key(key)))
+
+    def set_value(self, key, value, expiretime=None):
+        data = dumps(value)
+        if expiretime:
+            self.client.setex(self.key(key), int(expiretime), data)
+        else:
+            self.client.set(self.key(key), data)
+
+    def __delitem__(self, key):
+        self.client.delete(self.key(key))
+
+    def keys(self):
+        prefix = self.key('')
+        return [key.decode('utf-8')[len(prefix):] for key in self.client.scan_iter(match=prefix + '*')]
+
+    def do_remove(self):
+        for key in self.keys():
+            del self[key]
+
+
+class LmdbNamespaceManager(SharedNamespaceManager):
+    """Beaker namespace in an LMDB database in data_dir, shared by the processes of the host.
+
+    Readers don't wait for each other or for the writer. LMDB does not
+    expire entries, expired entries are skipped when they are read and
+    removed when the database of map_size bytes is full.
+    """
+
+    # open environments per (process, data_dir), an environment can't be used after a fork
+    environments = {}
+
+    def __init__(self, namespace, data_dir, map_size=1 << 30, **kwargs):
+        super(LmdbNamespaceManager, self).__init__(namespace)
+        self.data_dir = str(data_dir)
+        self.map_size = int(map_size)
+
+    @property
+    def env(self):
+        import lmdb
+        key = (os.getpid(), self.data_dir)
+        env = self.environments.get(key)
+        if env is None:
+            os.makedirs(self.data_dir, exist_ok=True)
+            env = self.environments.setdefault(key, lmdb.open(self.data_dir, map_size=self.map_size))
+        return env
+
+    def key(self, key):
+        return format_key(self.namespace, key).encode('utf-8')
+
+    def read(self, key):
+        """return the encoded value of key, None if missing or expired"""
+        with self.env.begin(buffers=True) as txn:
+            data = txn.get(self.key(key))
+            if data is None:
+                return None
+            (expires, ) = EXPIRES.unpack_from(data)
+            if expires and expires < time.time():
+                return None
+            return bytes(data[EXPIRES.size:])
+
+    def __getitem__(self, key):
+        data = self.read(key)
+        if data is None:
+            raise KeyError(key)
+        return loads(data)
+
+    def __contains__(self, key):
+        return self.read(key) is not None
+
+    def set_value(self, key, value, expiretime=None):
+        import lmdb
+        expires = time.time() + expiretime if expiretime else 0
+        data = EXPIRES.pack(expires) + dumps(value)
+        try:
+            with self.env.begin(write=True) as txn:
+                txn.put(self.key(key), data)
+        except lmdb.MapFullError:
+            self.purge()
+            try:
+                with self.env.begin(write=True) as txn:
+                    txn.put(self.key(key), data)
+            except lmdb.MapFullError:
+                logger.warning("cache in %s is full, not caching %s", self.data_dir, key)
+
+    def purge(self):
+        """remove the expired entries of all namespaces"""
+        now = time.time()
+        with self.env.begin(write=True) as txn:
+            cursor = txn.cursor()
+            expired = [
+                key
+                for key, data in cursor
+                if 0 < EXPIRES.unpack_from(data)[0] < now
+            ]
+            for key in expired:
+                txn.delete(key)
+        logger.info("removed %s expired entries from the cache in %s", len(expired), self.data_dir)
+
+    def __delitem__(self, key):
+        with self.env.begin(write=True) as txn:
+            txn.delete(self.key(key))
+
+    def keys(self):
+        prefix = self.key('')
+        keys = []
+        with self.env.begin() as txn:
+            cursor = txn.cursor()
+            if cursor.set_range(prefix):
+                for key in cursor.iternext(values=False):
+                    if not key.startswith(prefix):
+                        break
+                    keys.append(key[len(prefix):].decode('utf-8'))
+        return keys
+
+    def do_remove(self):
+        for key in self.keys():
+            del self[key]
+
+
+# backend arguments and their setting names, without prefix
+BACKEND_SETTINGS = {
+    'stathakis.redis': {'url': 'URL'},
+    'stathakis.lmdb': {'data_dir': 'DIR', 'map_size': 'MAP_SIZE'}
+}
+
+
+def region_settings(config, prefix='CACHE_'):
+    """return the settings of a beaker region from the settings that start with prefix (CACHE_TYPE, ...)
+
+    Backends that are not available fall back to memory.
+    """
+    type_ = config.get(prefix + 'TYPE', 'memory')
+    settings = {
+        'type': type_,
+        'expire': config.get(prefix + 'EXPIRE', 60)
+    }
+    if type_ not in BACKEND_SETTINGS:
+        return settings
+    try:
+        if type_ == 'stathakis.redis':
+            import redis  # noqa: F401
+        else:
+            import lmdb  # noqa: F401
+        import pyarrow  # noqa: F401
+    except ImportError:
+        logger.exception("cache backend %s is not available, caching in memory", type_)
+        settings['type'] = 'memory'
+        return settings
+    for arg, key in BACKEND_SETTINGS[type_].items():
+        if config.get(prefix + key) is not None:
+            settings[arg] = config[prefix + key]
+    return settings
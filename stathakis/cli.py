@@ -5,7 +5,9 @@ import logging
 
 import click
 
+from . import config
 from .app import make_app
+from .measurements import ncep
 
 logger = logging.getLogger(__name__)
 
@@ -15,20 +17,84 @@ logger = logging.getLogger(__name__)
     default=False,
     help='Start application in debugger mode.'
 )
-def main(debug, args=None):
+@click.option(
+    '--production/--development',
+    default=False,
+    help='Serve with a pool of worker processes (gunicorn) instead of the development server.'
+)
+@click.option('--host', default='127.0.0.1', help='Address to listen on.')
+@click.option('--port', default=8080, help='Port to listen on.')
+@click.option(
+    '--workers',
+    default=4,
+    envvar='STATHAKIS_WORKERS',
+    help='Number of worker processes (production).'
+)
+@click.option('--threads', default=1, help='Number of threads per worker (production).')
+@click.option(
+    '--timeout',
+    default=120,
+    help='Restart workers that are silent for this many seconds (production).'
+)
+@click.option(
+    '--graceful-timeout',
+    default=30,
+    help='Seconds to finish requests on a reload or stop (production).'
+)
+@click.option(
+    '--preload/--no-preload',
+    default=True,
+    help='Load the app and data once, before the workers are forked (production).'
+)
+@click.option(
+    '--async', 'use_asyncio',
+    is_flag=True,
+    default=False,
+    help='Serve the station endpoints with asyncio, the other endpoints in --threads threads.'
+)
+def main(debug, production, host, port, workers, threads, timeout, graceful_timeout, preload, use_asyncio, args=None):
     """Console script for stathakis."""
     # configure logging
     level = logging.INFO
     if debug:
         level = logging.DEBUG
     logging.basicConfig(level=level)
+    if production:
+        # only needed in production
+        from .server import serve
+        serve(
+            host=host,
+            port=port,
+            workers=workers,
+            threads=threads,
+            timeout=timeout,
+            graceful_timeout=graceful_timeout,
+            preload=preload,
+            use_asyncio=use_asyncio
+        )
+        return
+    # configuration is loaded and grids are opened in make_app
     app = make_app()
-    # load configuration (connexxion app contains flask app)
-    app.app.config.from_object('stathakis.config')
-    configured = app.app.config.from_envvar('STATHAKIS_SETTINGS', silent=True)
-    if not configured:
-        logger.debug("configuration file not found. Use STATHAKIS_SETTINGS to point to config file.")
-    app.run(debug=debug, port=8080)
+    if use_asyncio:
+        import aiohttp.web
+        from .aio import make_aio_app
+        aiohttp.web.run_app(make_aio_app(app, threads=threads), host=host, port=port)
+        return
+    app.run(debug=debug, host=host, port=port)
+
+
+@click.command()
+@click.option(
+    '--data-dir',
+    default=None,
+    help='Directory with the NCEP files, defaults to NCEP_DATA_DIR from the configuration.'
+)
+def build_cache(data_dir):
+    """Rewrite the NCEP grids in a point-major layout for fast point series."""
+    logging.basicConfig(level=logging.INFO)
+    if data_dir is None:
+        data_dir = config.NCEP_DATA_DIR
+    ncep.build_point_cache(data_dir)
 
 
 if __name__ == "__main__":
@@ -5,3 +5,52 @@ if pathlib.Path('/data/noaa').exists():
     NCEP_DATA_DIR = '/data/noaa/ncep'
 else:
     NCEP_DATA_DIR = 'data/noaa/ncep'
+
+# local store of fetched ddl measurements, set to None to disable. Keep it on a
+# local filesystem (not the shared /data volume), sqlite can't be shared over NFS
+DDL_STORE_PATH = 'data/rws/series.sqlite'
+# seconds of recent data that are always fetched again
+DDL_STORE_LAG = 3600
+
+# connections to the ddl services of Rijkswaterstaat
+DDL_POOL_SIZE = 10
+DDL_MAX_CONCURRENT = 4
+DDL_CONNECT_TIMEOUT = 10
+DDL_READ_TIMEOUT = 60
+DDL_RETRIES = 3
+DDL_BACKOFF_FACTOR = 0.5
+# in-memory cache of recently requested ddl series
+DDL_CACHE_BYTES = 64 * 1024 * 1024
+# seconds of recent data that can still change, refreshed after DDL_CACHE_VOLATILE_EXPIRE seconds
+DDL_CACHE_VOLATILE = 7200
+DDL_CACHE_VOLATILE_EXPIRE = 60
+# seconds between catalogue refreshes, refreshed in a background thread
+DDL_CATALOGUE_REFRESH = 1800
+DDL_CATALOGUE_BACKGROUND = True
+# the processed catalogue is saved here, so a restart does not wait for the ddl services
+if pathlib.Path('/data/rws').exists():
+    DDL_SNAPSHOT_DIR = '/data/rws/catalogue'
+else:
+    DDL_SNAPSHOT_DIR = 'data/rws/catalogue'
+# parse ddl observations while they are downloaded, needs ijson
+DDL_STREAM = True
+# long ddl periods are fetched in chunks of this many days
+DDL_CHUNK_DAYS = 90
+# lock files that let processes wait for each other's ddl fetches, used with DDL_STORE_PATH
+DDL_LOCK_DIR = 'data/rws/locks'
+# cache of recent station responses: memory (per process), stathakis.lmdb (shared
+# by the processes of the host) or stathakis.redis (shared by all replicas)
+CACHE_TYPE = 'memory'
+CACHE_EXPIRE = 60
+# redis compatible server of stathakis.redis
+CACHE_URL = 'redis://localhost:6379/0'
+# database of stathakis.lmdb, removes expired responses when full, on a local filesystem
+CACHE_DIR = 'data/rws/cache'
+CACHE_MAP_SIZE = 1 << 30
+# Cache-Control max-age of the responses in seconds, they carry an ETag to revalidate
+HTTP_MAX_AGE = 3600
+# measurement windows that end within HTTP_RECENT seconds can still change
+HTTP_RECENT = 7200
+HTTP_RECENT_MAX_AGE = 60
+# older windows don't change
+HTTP_IMMUTABLE_MAX_AGE = 365 * 24 * 3600
@@ -3,35 +3,84 @@ import logging
 import dateutil
 import flask
 
+from .http_cache import (
+    add_cache_headers,
+    conditional,
+    has_measurements,
+    make_etag,
+    not_modified,
+    recent_max_age,
+    window_policy
+)
+from .responses import best_series_format, binary_formats, json_response, series_response
+
 from .measurements import (
     available_grids,
     available_grid_infos,
-    available_grid_measurements
+    available_grid_measurements,
+    available_grid_batch_measurements,
+    available_grid_bboxes,
+    available_grid_end_times,
+    available_grid_versions
 )
 
 from .measurements import (
     available_stations,
     available_stations_per_quantity,
     available_station_infos,
-    available_station_measurements
+    available_station_measurements,
+    available_station_versions
 )
 
 
 logger = logging.getLogger(__name__)
 
 
+def max_age():
+    return flask.current_app.config.get('HTTP_MAX_AGE', 3600)
+
+
+def parse_time(value):
+    """parse an optional date-time parameter"""
+    if value is None:
+        return None
+    return dateutil.parser.parse(value)
+
+
 def grids() -> list:
-    return available_grids
+    return conditional(
+        lambda: json_response(available_grids),
+        etag=make_etag(available_grids),
+        max_age=max_age()
+    )
 
 
 def grid_info(id) -> list:
     id = str(id)
     data_dir = flask.current_app.config["%s_DATA_DIR" % (id.upper(), )]
     fun = available_grid_infos[id]
-    return fun(data_dir)
+    modified = available_grid_versions[id](data_dir)
+    return conditional(
+        lambda: json_response(fun(data_dir)),
+        etag=make_etag(id, modified),
+        last_modified=modified,
+        max_age=max_age()
+    )
 
 
-def grid_measurements(id, quantity, lat, lon, start_time, end_time) -> list:
+def grid_measurements(
+        id,
+        quantity,
+        lat,
+        lon,
+        start_time,
+        end_time,
+        format=None,
+        interpolate=False,
+        variables=None,
+        resample=None,
+        aggregate='mean'
+) -> list:
     id = str(id)
     quantity = str(quantity)
     lat = float(lat)
@@ -39,53 +88,187 @@ def grid_measurements(id, quantity, lat, lon, start_time, end_time) -> list:
     start_time = dateutil.parser.parse(start_time)
     end_time = dateutil.parser.parse(end_time)
 
+    if format is None:
+        format = best_series_format(flask.request.accept_mimetypes)
+
     fun = available_grid_measurements[str(id)]
     # get the data directory from the configuration
     data_dir = flask.current_app.config["%s_DATA_DIR" % (str(id).upper(), )]
-    records = fun(
-        quantity=quantity,
-        lat=lat,
-        lon=lon,
-        start_time=start_time,
-        end_time=end_time,
-        data_dir=data_dir
+
+    def make_response():
+        try:
+            records = fun(
+                quantity=quantity,
+                lat=lat,
+                lon=lon,
+                start_time=start_time,
+                end_time=end_time,
+                data_dir=data_dir,
+                interpolate=bool(interpolate),
+                variables=variables,
+                resample=resample,
+                aggregate=aggregate
+            )
+        except ValueError as e:
+            flask.abort(400, str(e))
+        return series_response(records, format)
+
+    modified = available_grid_versions[id](data_dir)
+    # windows that end after the last time step get more data
+    available_until = available_grid_end_times[id](data_dir)
+    age, immutable = window_policy(end_time, flask.current_app.config, available_until)
+    return conditional(
+        make_response,
+        etag=make_etag(
+            id, modified, quantity, lat, lon, start_time, end_time, format,
+            bool(interpolate), variables, resample, aggregate
+        ),
+        last_modified=modified,
+        max_age=age,
+        immutable=immutable,
+        vary='Accept'
+    )
+
+
+def grid_measurements_batch(id, quantity, body) -> dict:
+    """return measurements for a list of locations"""
+    id = str(id)
+    quantity = str(quantity)
+    points = body['points']
+    # a GeoJSON MultiPoint or a list of [lon, lat] pairs
+    if isinstance(points, dict):
+        points = points['coordinates']
+    start_time = dateutil.parser.parse(body['start_time'])
+    end_time = dateutil.parser.parse(body['end_time'])
+
+    fun = available_grid_batch_measurements[id]
+    data_dir = flask.current_app.config["%s_DATA_DIR" % (id.upper(), )]
+    try:
+        records = fun(
+            quantity=quantity,
+            points=points,
+            start_time=start_time,
+            end_time=end_time,
+            data_dir=data_dir,
+            interpolate=bool(body.get('interpolate', False)),
+            variables=body.get('variables'),
+            resample=body.get('resample'),
+            aggregate=body.get('aggregate', 'mean')
+        )
+    except ValueError as e:
+        flask.abort(400, str(e))
+    return json_response(records)
+
+
+def grid_bbox(id, quantity, lat_min, lat_max, lon_min, lon_max, start_time, end_time, format='netcdf'):
+    """stream the measurements within a bounding box in a binary format"""
+    id = str(id)
+    quantity = str(quantity)
+    start_time = dateutil.parser.parse(start_time)
+    end_time = dateutil.parser.parse(end_time)
+
+    fun = available_grid_bboxes[id]
+    data_dir = flask.current_app.config["%s_DATA_DIR" % (id.upper(), )]
+    bbox = [float(lat_min), float(lat_max), float(lon_min), float(lon_max)]
+
+    def make_response():
+        try:
+            cube = fun(
+                quantity=quantity,
+                lat_min=bbox[0],
+                lat_max=bbox[1],
+                lon_min=bbox[2],
+                lon_max=bbox[3],
+                start_time=start_time,
+                end_time=end_time,
+                data_dir=data_dir
+            )
+        except ValueError as e:
+            flask.abort(400, str(e))
+        encode, mimetype = binary_formats[format]
+        return flask.Response(encode(cube), mimetype=mimetype)
+
+    modified = available_grid_versions[id](data_dir)
+    # windows that end after the last time step get more data
+    available_until = available_grid_end_times[id](data_dir)
+    age, immutable = window_policy(end_time, flask.current_app.config, available_until)
+    return conditional(
+        make_response,
+        etag=make_etag(id, modified, quantity, bbox, start_time, end_time, format),
+        last_modified=modified,
+        max_age=age,
+        immutable=immutable
     )
-    return records
 
 
 def stations() -> list:
-    return available_stations
+    return conditional(
+        lambda: json_response(available_stations),
+        etag=make_etag(available_stations),
+        max_age=max_age()
+    )
 
 
-def stations_per_quantity(dataset, quantity) -> list:
-    """return a list of all stations"""
+def stations_per_quantity(dataset, quantity, bbox=None, near=None, k=5) -> list:
+    """return a list of all stations, optionally within bbox or nearest to near"""
     # concatenate a list of all stations
     dataset = str(dataset)
     quantity = str(quantity)
+    if bbox is not None:
+        bbox = [float(x) for x in bbox]
+    if near is not None:
+        near = [float(x) for x in near]
+
+    k = int(k)
 
     fun = available_stations_per_quantity[dataset]
-    feature_collection = fun(quantity)
-    features = feature_collection.features
-    for feature in features:
-        feature.properties['dataset'] = dataset
-    return feature_collection
+    # features contain the dataset in their properties
+    version, modified = available_station_versions[dataset]()
+    return conditional(
+        lambda: json_response(fun(quantity, bbox=bbox, near=near, k=k)),
+        etag=make_etag(dataset, version, quantity, bbox, near, k),
+        last_modified=modified,
+        max_age=max_age()
+    )
 
 
 def station_info(dataset, id) -> object:
     fun = available_station_infos[dataset]
-    station_info = fun(id)
-    return station_info
+    version, modified = available_station_versions[dataset]()
+    return conditional(
+        lambda: json_response(fun(id)),
+        etag=make_etag(dataset, version, id),
+        last_modified=modified,
+        max_age=max_age()
+    )
 
 
 # api conforms to swagger capitalization
-def station_measurements(dataset, id, quantity, start_time=None, end_time=None) -> str:
+def station_measurements(dataset, id, quantity, start_time=None, end_time=None, format=None) -> str:
     dataset = str(dataset)
     id = str(id)
     quantity = str(quantity)
-    start_time = dateutil.parser.parse(start_time)
-    end_time = dateutil.parser.parse(end_time)
+    start_time = parse_time(start_time)
+    end_time = parse_time(end_time)
+    if format is None:
+        format = best_series_format(flask.request.accept_mimetypes)
 
     """return measurements for a quantity"""
     fun = available_station_measurements[dataset]
+
+    config = flask.current_app.config
+    age, immutable = window_policy(end_time, config)
+    # past windows with data are identified by the request, others by their body
+    etag = None
+    if immutable:
+        etag = make_etag(dataset, id, quantity, start_time, end_time, format)
+        response = not_modified(etag, max_age=age, immutable=True, vary='Accept')
+        if response is not None:
+            return response
+
     station_data = fun(id, quantity, start_time=start_time, end_time=end_time)
-    return station_data
+    if immutable and not has_measurements(station_data):
+        # might be a temporary failure upstream, check again soon
+        etag, age, immutable = None, recent_max_age(config), False
+    response = series_response(station_data, format)
+    return add_cache_headers(response, etag, max_age=age, immutable=immutable, vary='Accept')
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+"""HTTP caching: validators, Cache-Control policies and conditional requests.
+
+Responses get an ETag that is derived from the version of the data they
+are made of (a hash of the station catalogue, the modification time of
+the grid files) and the request, so a conditional request is answered
+with 304 Not Modified without reading the data. Measurement windows in
+the past don't change and are cached for a long time, recent windows
+only shortly.
+"""
+import calendar
+import datetime
+import hashlib
+
+import flask
+import werkzeug.http
+
+# default Cache-Control max-age settings, see stathakis.config
+MAX_AGE = 3600
+RECENT_MAX_AGE = 60
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+RECENT = 7200
+
+
+def make_etag(*parts):
+    """return an ETag for the version and request parts (their repr is hashed)"""
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+def body_etag(body):
+    """return an ETag for a response body"""
+    return hashlib.sha1(body).hexdigest()
+
+
+def timestamp(dt):
+    """return a datetime as seconds since the epoch, naive datetimes are in UTC"""
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(datetime.timezone.utc)
+    return calendar.timegm(dt.timetuple())
+
+
+def is_modified(headers, etag=None, last_modified=None):
+    """return False if the copy of the client, as given by the request headers, is current
+
+    If-None-Match is compared with etag, If-Modified-Since with the
+    last_modified time (seconds since the epoch) if there is no
+    If-None-Match.
+    """
+    if_none_match = headers.get('If-None-Match')
+    if if_none_match is not None:
+        if etag is None:
+            return True
+        return not werkzeug.http.parse_etags(if_none_match).contains_weak(etag)
+    if_modified_since = headers.get('If-Modified-Since')
+    if if_modified_since is not None and last_modified is not None:
+        since = werkzeug.http.parse_date(if_modified_since)
+        if since is not None:
+            # dates in headers have a resolution of a second
+            return int(last_modified) > timestamp(since)
+    return True
+
+
+def cache_control(max_age, immutable=False):
+    """return the Cache-Control value of a public response"""
+    value = 'public, max-age=%d' % (max_age, )
+    if immutable:
+        value += ', immutable'
+    return value
+
+
+def cache_headers(etag=None, last_modified=None, max_age=MAX_AGE, immutable=False, vary=None):
+    """return the caching headers of a response"""
+    headers = {'Cache-Control': cache_control(max_age, immutable)}
+    if etag is not None:
+        headers['ETag'] = werkzeug.http.quote_etag(etag)
+    if last_modified is not None:
+        headers['Last-Modified'] = werkzeug.http.http_date(last_modified)
+    if vary is not None:
+        headers['Vary'] = vary
+    return headers
+
+
+def recent_max_age(config):
+    return config.get('HTTP_RECENT_MAX_AGE', RECENT_MAX_AGE)
+
+
+def window_policy(end_time, config, available_until=None):
+    """return the max-age and immutability of a measurement window that ends at end_time
+
+    Windows that end more than HTTP_RECENT seconds ago don't change, if
+    the data is available until their end (available_until, the last
+    time of a grid).
+    """
+    recent = config.get('HTTP_RECENT', RECENT)
+    if end_time is not None:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        complete = available_until is None or timestamp(end_time) <= timestamp(available_until)
+        if complete and timestamp(now) - timestamp(end_time) > recent:
+            return config.get('HTTP_IMMUTABLE_MAX_AGE', IMMUTABLE_MAX_AGE), True
+    return recent_max_age(config), False
+
+
+def has_measurements(data):
+    """return True if one of the series of a measurements response has data"""
+    return any(len(series['data']) for series in data.get('series', []))
+
+
+def not_modified(etag, last_modified=None, max_age=MAX_AGE, immutable=False, vary=None):
+    """return a 304 response if the client's copy of etag is current, otherwise None"""
+    if is_modified(flask.request.headers, etag, last_modified):
+        return None
+    return add_cache_headers(flask.Response(status=304), etag, last_modified, max_age, immutable, vary)
+
+
+def add_cache_headers(response, etag=None, last_modified=None, max_age=MAX_AGE, immutable=False, vary=None):
+    """add the caching headers to a response, return 304 if the client has it
+
+    Without an etag the ETag is derived from the body, the response is
+    made but not sent if the client has it.
+    """
+    if etag is None and not response.is_streamed:
+        etag = body_etag(response.get_data())
+        if not is_modified(flask.request.headers, etag):
+            response = flask.Response(status=304)
+    for key, value in cache_headers(etag, last_modified, max_age, immutable, vary).items():
+        response.headers[key] = value
+    return response
+
+
+def conditional(make_response, etag=None, last_modified=None, max_age=MAX_AGE, immutable=False, vary=None):
+    """return make_response() with caching headers, or 304 if the client's copy is current"""
+    if etag is not None:
+        response = not_modified(etag, last_modified, max_age, immutable, vary)
+        if response is not None:
+            return response
+    return add_cache_headers(make_response(), etag, last_modified, max_age, immutable, vary)
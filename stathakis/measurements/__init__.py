@@ -13,6 +13,29 @@ available_grid_measurements = {
     "ncep": ncep.get_measurements
 }
 
+available_grid_batch_measurements = {
+    "ncep": ncep.get_measurements_batch
+}
+
+available_grid_bboxes = {
+    "ncep": ncep.get_bbox
+}
+
+# open the grid files once, shared between requests
+available_grid_stores = {
+    "ncep": ncep.get_store
+}
+
+# the version of the grid data, the modification time of the files
+available_grid_versions = {
+    "ncep": ncep.get_modified
+}
+
+# the last time step of the grid data, windows that end later are not complete
+available_grid_end_times = {
+    "ncep": ncep.get_end_time
+}
+
 available_stations = [
     "rws"
 ]
@@ -25,13 +48,40 @@ available_station_infos = {
     "rws": ddl.get_station_info
 }
 
+# the version of the stations (a hash) and the time they last changed
+available_station_versions = {
+    "rws": ddl.get_catalogue_version
+}
+
 available_station_measurements = {
     "rws": ddl.get_station_measurements
 }
 
+# coroutines for the asyncio server, see stathakis.aio
+available_async_station_measurements = {
+    "rws": ddl.get_station_measurements_async
+}
+
+
+def configure(config, start_threads=True):
+    """apply the application configuration to the measurement modules"""
+    ddl.configure(config, start_threads=start_threads)
+
+
+def after_fork(config):
+    """reopen files and connections in a forked worker process"""
+    ddl.after_fork(config)
+    ncep.after_fork()
+
+
 __all__ = [
     'available_grids',
+    'available_grid_stores',
+    'available_grid_versions',
+    'available_grid_end_times',
     'available_stations',
     'available_station_infos',
-    'available_station_measurements'
+    'available_station_versions',
+    'available_station_measurements',
+    'available_async_station_measurements'
 ]
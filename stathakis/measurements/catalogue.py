@@ -0,0 +1,391 @@
+import hashlib
+import json
+import logging
+import pathlib
+import threading
+import time
+
+import numpy as np
+
+from ..utils import RawJSON
+
+logger = logging.getLogger(__name__)
+
+
+class UnknownQuantityException(KeyError):
+    """the quantity has no filter in the station index"""
+
+
+class StationIndex(object):
+    """Stations of a catalogue, built once per catalogue fetch.
+
+    The index is shared by all requests, don't modify the frame. Row
+    positions are looked up by station code, by quantity code and by
+    quantity group (filters). The GeoJSON features are rendered once, so
+    feature collections are assembled without encoding the stations again.
+    The version is a hash of the features and filters, the same in every
+    process that loads the same catalogue. `modified` is the time the
+    stations last changed, if known.
+    """
+
+    def __init__(self, df, filters, properties=None, features=None, modified=None):
+        self.df = df
+        self.filters = filters
+        self.by_code = df.groupby('code').indices
+        self.by_quantity = df.groupby('quantity').indices
+        self.by_filter = {}
+        for name, codes in filters.items():
+            positions = [self.by_quantity[code] for code in codes if code in self.by_quantity]
+            self.by_filter[name] = np.sort(np.concatenate(positions)) if positions else np.array([], dtype='int64')
+        if features is None:
+            self.features = self.render_features(properties or {})
+        else:
+            # rendered before, see load_snapshot
+            self.features = [RawJSON(feature) for feature in features]
+        digest = hashlib.sha1(json.dumps(filters, sort_keys=True).encode('utf-8'))
+        for feature in self.features:
+            digest.update(feature.encoded_json.encode('utf-8'))
+        self.version = digest.hexdigest()
+        self.modified = modified
+        # spatial index, sorted longitudes for boxes and points on the
+        # unit sphere for nearest stations
+        self.lon = df.lon.values
+        self.lat = df.lat.values
+        self.lon_order = np.argsort(self.lon, kind='mergesort')
+        self.lon_sorted = self.lon[self.lon_order]
+        self.xyz = lonlat2xyz(self.lon, self.lat)
+        self.trees = {}
+
+    def render_features(self, extra_properties):
+        """render every station as a GeoJSON feature"""
+        # let pandas encode all columns in one pass
+        records = json.loads(self.df.to_json(orient='records', double_precision=15))
+        features = []
+        for id, record in zip(self.df.index, records):
+            record.update(extra_properties)
+            feature = {
+                "type": "Feature",
+                "id": int(id),
+                "geometry": {
+                    "type": "Point",
+                    "coordinates": [record['lon'], record['lat']]
+                },
+                "properties": record
+            }
+            features.append(RawJSON(json.dumps(feature)))
+        return features
+
+    def positions(self, code=None, quantity=None):
+        """return the row positions of a station and/or quantity group"""
+        if code is None and quantity is None:
+            return np.arange(len(self.df))
+        selected = None
+        if code is not None:
+            selected = self.by_code.get(code, np.array([], dtype='int64'))
+        if quantity is not None:
+            if quantity not in self.by_filter:
+                raise UnknownQuantityException(quantity)
+            quantity_positions = self.by_filter[quantity]
+            if selected is None:
+                selected = quantity_positions
+            else:
+                selected = np.intersect1d(selected, quantity_positions)
+        return selected
+
+    def within(self, bbox):
+        """return the row positions within bbox (lon_min, lat_min, lon_max, lat_max)
+
+        A box with lon_min > lon_max crosses the antimeridian.
+        """
+        lon_min, lat_min, lon_max, lat_max = bbox
+        if lon_min > lon_max:
+            ranges = [(lon_min, np.inf), (-np.inf, lon_max)]
+        else:
+            ranges = [(lon_min, lon_max)]
+        candidates = np.concatenate([
+            self.lon_order[
+                np.searchsorted(self.lon_sorted, range_min, side='left'):
+                np.searchsorted(self.lon_sorted, range_max, side='right')
+            ]
+            for range_min, range_max in ranges
+        ])
+        lat = self.lat[candidates]
+        return np.sort(candidates[(lat >= lat_min) & (lat <= lat_max)])
+
+    def tree(self, quantity):
+        """return a kd-tree over the stations of a quantity group, if scipy is available"""
+        if quantity not in self.trees:
+            try:
+                import scipy.spatial
+            except ImportError:
+                self.trees[quantity] = None
+            else:
+                positions = self.positions(quantity=quantity)
+                self.trees[quantity] = (positions, scipy.spatial.cKDTree(self.xyz[positions]))
+        return self.trees[quantity]
+
+    def nearest(self, near, k, quantity=None):
+        """return the row positions of the k nearest stations, nearest first
+
+        Stations have a row per quantity, all rows of the k nearest
+        station codes in the quantity group are returned.
+        """
+        lon, lat = near
+        positions = self.positions(quantity=quantity)
+        if not len(positions):
+            return positions
+        point = lonlat2xyz(np.array([lon]), np.array([lat]))[0]
+        tree = self.tree(quantity)
+        if tree is None:
+            distance = np.sum((self.xyz[positions] - point) ** 2, axis=1)
+        # stations have a few rows, look at more rows until k stations are found
+        n = min(len(positions), 4 * k)
+        while True:
+            if tree is not None:
+                tree_positions, kdtree = tree
+                _, idx = kdtree.query(point, k=n)
+                ordered = tree_positions[np.atleast_1d(idx)]
+            else:
+                idx = np.argpartition(distance, n - 1)[:n]
+                ordered = positions[idx[np.argsort(distance[idx])]]
+            codes = self.df.code.values[ordered]
+            _, first = np.unique(codes, return_index=True)
+            if len(first) >= k or n == len(positions):
+                break
+            n = min(2 * n, len(positions))
+        selected_codes = codes[np.sort(first)[:k]]
+        # all rows of the selected stations, some might be beyond the first n
+        selected = positions[np.isin(self.df.code.values[positions], selected_codes)]
+        rank = {code: i for i, code in enumerate(selected_codes)}
+        order = np.argsort([rank[code] for code in self.df.code.values[selected]], kind='mergesort')
+        return selected[order]
+
+    def select(self, code=None, quantity=None):
+        """return the stations that match code and quantity group"""
+        return self.df.iloc[self.positions(code=code, quantity=quantity)]
+
+    def feature_collection(self, code=None, quantity=None, bbox=None, near=None, k=5):
+        """return the pre-rendered features as a feature collection
+
+        Optionally only the stations within bbox or the k stations nearest
+        to near (lon, lat) are returned.
+        """
+        if near is not None:
+            positions = self.nearest(near, k, quantity=quantity)
+        else:
+            positions = self.positions(code=code, quantity=quantity)
+        if bbox is not None:
+            positions = positions[np.isin(positions, self.within(bbox))]
+        return {
+            "type": "FeatureCollection",
+            "features": [
+                self.features[i]
+                for i
+                in positions
+            ]
+        }
+
+
+def lonlat2xyz(lon, lat):
+    """return points on the unit sphere, distances don't depend on longitude wrapping"""
+    lon = np.radians(lon)
+    lat = np.radians(lat)
+    return np.column_stack([
+        np.cos(lat) * np.cos(lon),
+        np.cos(lat) * np.sin(lon),
+        np.sin(lat)
+    ])
+
+
+class CatalogueRefresher(object):
+    """Keep a catalogue fresh in the background.
+
+    Requests get the current catalogue and don't wait for a refresh. Only
+    when there is no catalogue yet, one request loads it and the others
+    wait for it. A catalogue older than `interval` seconds is served while
+    a new one is loaded, the new catalogue is swapped in at once. If
+    loading fails the old catalogue is kept and the next load is tried
+    after a delay.
+    """
+
+    def __init__(self, load, interval=1800):
+        self.load = load
+        self.interval = interval
+        # (catalogue, time loaded), replaced as a whole
+        self.current = None
+        self.lock = threading.Lock()
+        self.thread = None
+        # refresh of a stale catalogue started by a request, one at a time
+        self.refresh_thread = None
+        self.refresh_lock = threading.Lock()
+        # time of the last failed load
+        self.failed = None
+
+    def is_fresh(self):
+        current = self.current
+        return current is not None and time.time() - current[1] < self.interval
+
+    def get(self):
+        """return the current catalogue, load it if there is none"""
+        current = self.current
+        if current is None:
+            self.refresh()
+            current = self.current
+        elif not self.is_fresh():
+            self.refresh_in_background()
+        return current[0]
+
+    def retry_delay(self):
+        """seconds to wait after a failed load"""
+        return min(60, self.interval * 0.1)
+
+    def refresh_in_background(self):
+        """start a refresh in a thread, unless one runs or the last load failed recently"""
+        if self.thread is not None and self.thread.is_alive():
+            # the background refresher retries by itself
+            return
+        if self.failed is not None and time.time() - self.failed < self.retry_delay():
+            return
+        with self.refresh_lock:
+            if self.refresh_thread is not None and self.refresh_thread.is_alive():
+                return
+            self.refresh_thread = threading.Thread(target=self.refresh_quietly, kwargs={'blocking': False})
+            self.refresh_thread.daemon = True
+            self.refresh_thread.start()
+
+    def refresh(self, blocking=True, force=False):
+        """load a new catalogue, one load at a time"""
+        if not self.lock.acquire(blocking):
+            return False
+        try:
+            # another thread may have loaded it while we waited
+            if not force and self.is_fresh():
+                return False
+            try:
+                catalogue = self.load()
+            except Exception:
+                self.failed = time.time()
+                raise
+            self.failed = None
+            self.current = (catalogue, time.time())
+            return True
+        finally:
+            self.lock.release()
+
+    def refresh_quietly(self, **kwargs):
+        """refresh, keep the old catalogue on errors"""
+        try:
+            return self.refresh(**kwargs)
+        except Exception:
+            logger.exception("could not refresh catalogue, keeping the current one")
+            return False
+
+    def start(self):
+        """refresh the catalogue in a background thread, before it gets stale"""
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.thread = threading.Thread(target=self.run, name='catalogue-refresher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def after_fork(self):
+        """forget the lock and thread of the parent process, threads don't survive a fork"""
+        self.lock = threading.Lock()
+        self.thread = None
+        self.refresh_thread = None
+        self.refresh_lock = threading.Lock()
+
+    def seed(self, catalogue, loaded):
+        """use a catalogue that was loaded before (at time loaded), if there is none"""
+        with self.lock:
+            if self.current is None:
+                self.current = (catalogue, loaded)
+
+    def run(self):
+        while True:
+            current = self.current
+            due = current[1] + self.interval * 0.9 if current is not None else 0
+            if time.time() < due:
+                time.sleep(due - time.time())
+                continue
+            if not self.refresh_quietly(force=True):
+                # retry sooner after an error
+                time.sleep(self.retry_delay())
+
+
+# version of the snapshot format
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = 'catalogue.json'
+
+
+def save_snapshot(snapshot_dir, index, loaded):
+    """save the station index to snapshot_dir, so it can be loaded at startup
+
+    The stations are stored as feather, the nested columns as JSON text,
+    next to the rendered features as GeoJSON. The header is replaced
+    last, it points to the files of the current snapshot.
+    """
+    try:
+        import pyarrow.feather
+    except ImportError:
+        logger.warning("pyarrow is not available, not saving a catalogue snapshot")
+        return None
+    snapshot_dir = pathlib.Path(snapshot_dir)
+    snapshot_dir.mkdir(parents=True, exist_ok=True)
+    name = 'stations-%d' % (int(loaded * 1000), )
+    df = index.df.reset_index()
+    json_columns = [
+        column
+        for column in df.columns
+        if df[column].map(lambda x: isinstance(x, (dict, list))).any()
+    ]
+    for column in json_columns:
+        df[column] = df[column].map(json.dumps)
+    pyarrow.feather.write_feather(df, str(snapshot_dir / (name + '.feather')))
+    with (snapshot_dir / (name + '.geojson')).open('w') as f:
+        f.write('{"type": "FeatureCollection", "features": [\n')
+        f.write(',\n'.join(feature.encoded_json for feature in index.features))
+        f.write('\n]}\n')
+    header = {
+        "version": SNAPSHOT_VERSION,
+        "loaded": loaded,
+        "modified": index.modified,
+        "name": name,
+        "json_columns": json_columns,
+        "filters": index.filters
+    }
+    tmp_path = snapshot_dir / (SNAPSHOT_HEADER + '.tmp')
+    with tmp_path.open('w') as f:
+        json.dump(header, f)
+    tmp_path.replace(snapshot_dir / SNAPSHOT_HEADER)
+    # remove older snapshots
+    for path in snapshot_dir.glob('stations-*'):
+        if path.stem != name:
+            path.unlink()
+    return snapshot_dir / SNAPSHOT_HEADER
+
+
+def load_snapshot(snapshot_dir):
+    """return the station index of the snapshot and the time it was loaded, None if there is none"""
+    header_path = pathlib.Path(snapshot_dir) / SNAPSHOT_HEADER
+    if not header_path.exists():
+        return None
+    try:
+        import pyarrow.feather
+    except ImportError:
+        logger.warning("pyarrow is not available, not loading the catalogue snapshot")
+        return None
+    with header_path.open() as f:
+        header = json.load(f)
+    if header['version'] != SNAPSHOT_VERSION:
+        logger.info("ignoring catalogue snapshot version %s", header['version'])
+        return None
+    df = pyarrow.feather.read_feather(str(header_path.parent / (header['name'] + '.feather')))
+    for column in header['json_columns']:
+        df[column] = df[column].map(json.loads)
+    df = df.set_index('index')
+    df.index.name = None
+    with (header_path.parent / (header['name'] + '.geojson')).open() as f:
+        features = [line.rstrip(',') for line in f.read().splitlines()[1:-1]]
+    index = StationIndex(df, header['filters'], features=features, modified=header.get('modified'))
+    return index, header['loaded']
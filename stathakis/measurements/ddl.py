@@ -1,35 +1,118 @@
+import array
+import asyncio
+import concurrent.futures
+import decimal
 import functools
-import logging
+import io
 import json
+import logging
 import datetime
+import time
 
-import requests
 import numpy as np
 import pandas as pd
 import osgeo.osr
-import geojson
 import dateutil.parser
-import shapely.geometry
 import beaker.cache
 
-from ..utils import CustomEncoder, df2geojson
+from ..cache import region_settings
+from ..singleflight import SingleFlight
+from ..upstream import UpstreamClient
+from .catalogue import CatalogueRefresher, StationIndex, load_snapshot, save_snapshot
+from . import intervals
+from .intervals import IntervalCache
+from .store import EPOCH, SeriesStore
 
 logger = logging.getLogger(__name__)
 
-# set cache settings
+# set cache settings, the backend is configured by the CACHE_* settings, see configure
 beaker.cache.cache_regions.update({
     'short_term': {
         'expire': 60,
         'type': 'memory'
     },
-    'long_term': {
-        'expire': 1800,
-        'type': 'dbm',
-        'data_dir': '/tmp',
-    }
 })
 
 cache = beaker.cache.CacheManager()
+# the short_term region of the coroutines, which can't be decorated, see configure
+measurements_cache = beaker.cache.Cache(
+    'stathakis.measurements.ddl:measurements',
+    **beaker.cache.cache_regions['short_term']
+)
+
+# all requests to the ddl services go through the client, see configure
+client = UpstreamClient()
+# the series of a station are fetched concurrently
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=client.max_concurrent)
+
+
+# local store of fetched measurements, see configure
+store = None
+# recently requested series, in memory
+series_cache = IntervalCache()
+# directory of the catalogue snapshot, see configure
+snapshot_dir = None
+# parse observations while they are downloaded (needs ijson), see configure
+stream_observations = True
+# long periods are fetched in chunks of this size, see configure
+chunk_size = datetime.timedelta(days=90)
+# identical concurrent fetches are done once, see configure
+flights = SingleFlight()
+
+
+def configure(config, start_threads=True):
+    """configure the connections to the ddl services and the local store (DDL_* settings)
+
+    Without start_threads the fetch executor and the background catalogue
+    refresher are not started, as in the master process of a preloaded
+    server. They are started by after_fork in the workers.
+    """
+    global client, executor, store, series_cache, snapshot_dir, stream_observations, chunk_size, flights
+    global measurements_cache
+    client = UpstreamClient.from_config(config, 'DDL_')
+    if start_threads:
+        executor.shutdown(wait=False)
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=client.max_concurrent)
+    if config.get('DDL_STORE_PATH'):
+        store = SeriesStore(config['DDL_STORE_PATH'], lag=config.get('DDL_STORE_LAG', 3600))
+    else:
+        store = None
+    series_cache = IntervalCache(
+        max_bytes=config.get('DDL_CACHE_BYTES', 64 * 1024 * 1024),
+        volatile=config.get('DDL_CACHE_VOLATILE', 7200),
+        volatile_expire=config.get('DDL_CACHE_VOLATILE_EXPIRE', 60)
+    )
+    stream_observations = config.get('DDL_STREAM', True)
+    chunk_size = datetime.timedelta(days=config.get('DDL_CHUNK_DAYS', 90))
+    # coalesce fetches between processes through the local store
+    flights = SingleFlight(config.get('DDL_LOCK_DIR') if store is not None else None)
+    # before the first request, the decorated functions keep their cache
+    beaker.cache.cache_regions['short_term'] = region_settings(config)
+    measurements_cache = beaker.cache.Cache(
+        'stathakis.measurements.ddl:measurements',
+        **beaker.cache.cache_regions['short_term']
+    )
+    catalogue_refresher.interval = config.get('DDL_CATALOGUE_REFRESH', 1800)
+    snapshot_dir = config.get('DDL_SNAPSHOT_DIR')
+    if snapshot_dir:
+        # start with the last catalogue, refreshed if it is too old
+        try:
+            snapshot = load_snapshot(snapshot_dir)
+        except (IOError, OSError, ValueError, KeyError):
+            logger.exception("could not load the catalogue snapshot in %s", snapshot_dir)
+            snapshot = None
+        if snapshot is not None:
+            index, loaded = snapshot
+            catalogue_refresher.seed({"metadata": None, "index": index}, loaded)
+    if start_threads and config.get('DDL_CATALOGUE_BACKGROUND', True):
+        catalogue_refresher.start()
+
+
+def after_fork(config):
+    """reconfigure in a forked process, the connections and threads of the parent can't be used"""
+    catalogue_refresher.after_fork()
+    configure(config)
+
 
 WGS84 = osgeo.osr.SpatialReference()
 WGS84.ImportFromEPSG(4326)
@@ -76,6 +159,9 @@ AQUO2CF = {
     'WINDSHD': 'wind_speed'
 }
 
+# name of the dataset in the api
+DATASET = 'rws'
+
 FILTERS = {
     "waterlevel": ['WATHTBRKD', 'WATHTE'],
     "wind": ['WINDRTG', 'WINDSHD']
@@ -86,9 +172,9 @@ class NoDataException(BaseException):
     pass
 
 
-# this takes 6 seconds, which is much too long, so we cache it
-@cache.region('long_term', 'rws')
-def get_metadata():
+# this takes 6 seconds, which is much too long, so it is refreshed in the
+# background, see catalogue_refresher
+def fetch_metadata():
     """extract metadata from ddl"""
     ddl_url = 'https://waterwebservices.rijkswaterstaat.nl/METADATASERVICES_DBO/OphalenCatalogus/'
 
@@ -99,13 +185,11 @@ def get_metadata():
             "Hoedanigheden": True
         }
     }
-    resp = requests.post(ddl_url, json=request)
+    resp = client.post(ddl_url, json=request)
     result = resp.json()
     return result
 
 
-# this function is slow because every record can have a different coordinate system
-@cache.region('short_term', 'rws')
 def metadata2df(metadata, quantity=None):
     """parse ddl data and return a data frame"""
     locaties_df = pd.DataFrame.from_dict(metadata['LocatieLijst'])
@@ -129,28 +213,20 @@ def metadata2df(metadata, quantity=None):
     srs = osgeo.osr.SpatialReference()
     srs.ImportFromEPSG(int(crs))
     srs2wgs84 = osgeo.osr.CoordinateTransformation(srs, WGS84)
-    points = srs2wgs84.TransformPoints(np.array(merged_df[['x', 'y']]))
-    points = [
-        shapely.geometry.Point(pt[0], pt[1])
-        for pt
-        in points
-    ]
-
-    # this is very slow because we check coordinate system for each row
-    merged_df['point'] = points
-    merged_df['lon'] = merged_df.point.apply(lambda pt: pt.x)
-    merged_df['lat'] = merged_df.point.apply(lambda pt: pt.y)
+    # transform all points in one call
+    points = np.asarray(srs2wgs84.TransformPoints(np.array(merged_df[['x', 'y']])))
+    merged_df['lon'] = points[:, 0]
+    merged_df['lat'] = points[:, 1]
 
     # flatten some columns
-    merged_df['units'] = merged_df.eenheid.apply(lambda x: x['Code'])
-    merged_df['quantity'] = merged_df.grootheid.apply(lambda x: x['Code'])
+    merged_df['units'] = merged_df.eenheid.str.get('Code')
+    merged_df['quantity'] = merged_df.grootheid.str.get('Code')
 
-    merged_df['standard_name'] = merged_df.grootheid.apply(lambda x: AQUO2CF.get(x['Code'], ''))
+    merged_df['standard_name'] = merged_df.quantity.map(AQUO2CF).fillna('')
 
     if quantity:
         # only show stations of relevant quantity
-        idx = np.in1d(merged_df.quantity, FILTERS[quantity])
-        filtered_df = merged_df[idx]
+        filtered_df = merged_df[merged_df.quantity.isin(FILTERS[quantity])]
     else:
         filtered_df = merged_df
     # TODO:
@@ -159,13 +235,226 @@ def metadata2df(metadata, quantity=None):
     return filtered_df
 
 
+def load_catalogue():
+    """fetch the catalogue and build the station index, one process at a time"""
+    return flights.do('catalogue', fetch_catalogue, lock_key='catalogue')
 
-@cache.region('short_term', 'rws')
-def get_series(row, start_time, end_time, validated=False):
-    """get timeseries for a given row"""
-    station = row
 
-    metadata_url = 'https://waterwebservices.rijkswaterstaat.nl/ONLINEWAARNEMINGENSERVICES_DBO/OphalenWaarnemingen'
+def fetch_catalogue():
+    """fetch the catalogue and build the station index
+
+    If another process saved a recent snapshot while we waited, that one
+    is used. The stations keep the modified time of the current catalogue
+    or the snapshot if they did not change.
+    """
+    snapshot = None
+    if snapshot_dir:
+        try:
+            snapshot = load_snapshot(snapshot_dir)
+        except (IOError, OSError, ValueError, KeyError):
+            logger.exception("could not load the catalogue snapshot in %s", snapshot_dir)
+        recent = snapshot is not None and time.time() - snapshot[1] < catalogue_refresher.interval * 0.5
+        if recent and flights.lock_dir is not None:
+            return {"metadata": None, "index": snapshot[0]}
+    metadata = fetch_metadata()
+    metadata_df = metadata2df(metadata)
+    index = StationIndex(metadata_df, FILTERS, properties={'dataset': DATASET}, modified=time.time())
+    previous = [snapshot[0]] if snapshot is not None else []
+    if catalogue_refresher.current is not None:
+        previous.append(catalogue_refresher.current[0]['index'])
+    for previous_index in previous:
+        if previous_index.version == index.version and previous_index.modified is not None:
+            index.modified = min(index.modified, previous_index.modified)
+    if snapshot_dir:
+        try:
+            save_snapshot(snapshot_dir, index, time.time())
+        except (IOError, OSError):
+            logger.exception("could not save the catalogue snapshot in %s", snapshot_dir)
+    return {
+        "metadata": metadata,
+        "index": index
+    }
+
+
+catalogue_refresher = CatalogueRefresher(load_catalogue)
+
+
+def get_metadata():
+    """return the current ddl catalogue"""
+    catalogue = catalogue_refresher.get()
+    if catalogue['metadata'] is None:
+        # started from a snapshot, which only contains the stations, fetch it
+        # once for this catalogue
+        catalogue['metadata'] = flights.do('metadata', fetch_metadata)
+    return catalogue['metadata']
+
+
+def get_station_index():
+    """return the index of all stations, built once per catalogue fetch"""
+    return catalogue_refresher.get()['index']
+
+
+def get_catalogue_version():
+    """return the version of the stations (a hash of the catalogue) and the time they last changed"""
+    index = get_station_index()
+    return index.version, index.modified
+
+
+def measurements2df(measurements, validated=False):
+    """convert a ddl MetingenLijst to a data frame with value, dateTime, status and quality columns
+
+    The status and quality codes of a measurement are joined with a
+    comma. If validated, only measurements with status Gecontroleerd
+    are returned.
+    """
+    n = len(measurements)
+    values = np.empty(n, dtype='float64')
+    times = [None] * n
+    status = [None] * n
+    quality = [None] * n
+    checked = np.zeros(n, dtype='bool')
+    for i, measurement in enumerate(measurements):
+        value = measurement['Meetwaarde'].get('Waarde_Numeriek')
+        values[i] = np.nan if value is None else value
+        times[i] = measurement['Tijdstip']
+        measurement_metadata = measurement.get('WaarnemingMetadata', {})
+        status_list = measurement_metadata.get('StatuswaardeLijst', [])
+        checked[i] = 'Gecontroleerd' in status_list
+        status[i] = ','.join(status_list)
+        quality[i] = ','.join(measurement_metadata.get('KwaliteitswaardecodeLijst', []))
+    df = pd.DataFrame({
+        'value': values,
+        # parse all times at once, in UTC
+        'dateTime': pd.to_datetime(pd.Series(times, dtype='object'), utc=True),
+        'status': pd.Series(status, dtype='object'),
+        'quality': pd.Series(quality, dtype='object')
+    }, columns=['value', 'dateTime', 'status', 'quality'])
+    if validated:
+        # only validated data if requested
+        df = df[checked].reset_index(drop=True)
+    return df
+
+
+# prefixes of the OphalenWaarnemingen response, as reported by ijson
+OBSERVATION = 'WaarnemingenLijst.item'
+MEASUREMENT = OBSERVATION + '.MetingenLijst.item'
+OBSERVATION_METADATA = {OBSERVATION + '.AquoMetadata', OBSERVATION + '.Locatie'}
+# times are parsed per chunk of measurements
+TIME_CHUNK = 10000
+
+
+@functools.lru_cache()
+def ijson_available():
+    """return whether the streaming parser can be used"""
+    try:
+        import ijson  # noqa: F401
+    except ImportError:
+        logger.info("ijson is not available, observations are parsed after they are read")
+        return False
+    return True
+
+
+def parse_observations(stream, validated=False):
+    """parse an OphalenWaarnemingen response while it is read
+
+    Returns the metadata and a data frame like measurements2df. The
+    measurements are not kept as dicts, they are added to typed arrays.
+    Status and quality codes are stored as small integers, the times are
+    parsed per chunk.
+    """
+    import ijson
+
+    succesvol = None
+    foutmelding = None
+    metadata = {}
+    builder = None
+    builder_prefix = None
+
+    values = array.array('d')
+    times = array.array('q')
+    time_chunk = []
+    status = array.array('l')
+    quality = array.array('l')
+    checked = array.array('b')
+    codes = {}
+
+    def code(text):
+        return codes.setdefault(text, len(codes))
+
+    def parse_times():
+        parsed = pd.to_datetime(pd.Series(time_chunk, dtype='object'), utc=True)
+        milliseconds = (parsed - EPOCH) // pd.Timedelta(milliseconds=1)
+        times.frombytes(milliseconds.values.astype('int64').tobytes())
+        del time_chunk[:]
+
+    for prefix, event, value in ijson.parse(stream):
+        if builder is not None:
+            if isinstance(value, decimal.Decimal):
+                # ijson parses non-integer numbers as decimals, which can't be stored as JSON
+                value = float(value)
+            builder.event(event, value)
+            if prefix == builder_prefix and event == 'end_map':
+                if prefix.endswith('AquoMetadata'):
+                    standard_name = AQUO2CF.get(builder.value.get('Grootheid', {}).get('Code'))
+                    metadata.update(builder.value)
+                    metadata['standard_name'] = standard_name
+                else:
+                    metadata.update(builder.value)
+                builder = None
+        elif prefix in OBSERVATION_METADATA and event == 'start_map':
+            builder = ijson.ObjectBuilder()
+            builder_prefix = prefix
+            builder.event(event, value)
+        elif prefix == MEASUREMENT:
+            if event == 'start_map':
+                measurement_value = np.nan
+                measurement_time = None
+                status_list = []
+                quality_list = []
+            elif event == 'end_map':
+                values.append(measurement_value)
+                time_chunk.append(measurement_time)
+                if len(time_chunk) >= TIME_CHUNK:
+                    parse_times()
+                status.append(code(','.join(status_list)))
+                quality.append(code(','.join(quality_list)))
+                checked.append('Gecontroleerd' in status_list)
+        elif prefix == MEASUREMENT + '.Tijdstip':
+            measurement_time = value
+        elif prefix == MEASUREMENT + '.Meetwaarde.Waarde_Numeriek':
+            measurement_value = np.nan if value is None else float(value)
+        elif prefix == MEASUREMENT + '.WaarnemingMetadata.StatuswaardeLijst.item':
+            status_list.append(value)
+        elif prefix == MEASUREMENT + '.WaarnemingMetadata.KwaliteitswaardecodeLijst.item':
+            quality_list.append(value)
+        elif prefix == 'Succesvol':
+            succesvol = value
+        elif prefix == 'Foutmelding':
+            foutmelding = value
+    if not succesvol:
+        raise NoDataException(foutmelding)
+    if time_chunk:
+        parse_times()
+
+    labels = np.array(sorted(codes, key=codes.get) or [''], dtype='object')
+    df = pd.DataFrame({
+        'value': np.asarray(values, dtype='float64'),
+        'dateTime': pd.to_datetime(np.asarray(times, dtype='int64'), unit='ms', utc=True),
+        'status': pd.Series(labels[np.asarray(status, dtype='int64')], dtype='object'),
+        'quality': pd.Series(labels[np.asarray(quality, dtype='int64')], dtype='object')
+    }, columns=['value', 'dateTime', 'status', 'quality'])
+    if validated:
+        # only validated data if requested
+        df = df[np.asarray(checked, dtype='bool')].reset_index(drop=True)
+    return metadata, df
+
+
+OBSERVATIONS_URL = 'https://waterwebservices.rijkswaterstaat.nl/ONLINEWAARNEMINGENSERVICES_DBO/OphalenWaarnemingen'
+
+
+def observations_request(row, start_time, end_time):
+    """return the OphalenWaarnemingen request for the series of a row"""
+    station = row
     request = {
         "AquoPlusWaarnemingMetadata": {
             "AquoMetadata": {
@@ -184,9 +473,11 @@ def get_series(row, start_time, end_time, validated=False):
             "Einddatumtijd": end_time.isoformat()
         }
     }
-    logger.debug('Getting url with data %s', request)
-    resp = requests.post(metadata_url, json=request)
-    data = resp.json()
+    return request
+
+
+def parse_observations_json(data, validated=False):
+    """return the metadata and the data frame of a parsed OphalenWaarnemingen response"""
     if not data['Succesvol']:
         raise NoDataException(data['Foutmelding'])
     measurements = []
@@ -197,24 +488,28 @@ def get_series(row, start_time, end_time, validated=False):
         standard_name = AQUO2CF.get(row['AquoMetadata']['Grootheid']['Code'])
         metadata['standard_name'] = standard_name
         metadata.update(row['Locatie'])
-        for measurement in row['MetingenLijst']:
-            # only add validated data if requested
-            if validated and 'Gecontroleerd' not in measurement['WaarnemingMetadata']['StatuswaardeLijst']:
-                continue
-            measurements.append(measurement)
-
-    timeseries = []
-    for measurement in measurements:
-        record = {}
-        record['value'] = measurement['Meetwaarde']['Waarde_Numeriek']
-
-        # parse time
-        date = dateutil.parser.parse(measurement['Tijdstip'])
-        # convert to UTC
-        record['dateTime'] = date.astimezone(UTC)
-        timeseries.append(record)
-    timeseries_df = pd.DataFrame(timeseries)
-    series = timeseries_df
+        measurements.extend(row['MetingenLijst'])
+    series = measurements2df(measurements, validated=validated)
+    return metadata, series
+
+
+def get_series(row, start_time, end_time, validated=False):
+    """get timeseries for a given row"""
+    request = observations_request(row, start_time, end_time)
+    logger.debug('Getting url with data %s', request)
+    if stream_observations and ijson_available():
+        # don't keep the whole response in memory, parse it while it is read
+        with client.stream(OBSERVATIONS_URL, json=request) as resp:
+            resp.raw.decode_content = True
+            metadata, series = parse_observations(resp.raw, validated=validated)
+        return series_info(metadata, series)
+    resp = client.post(OBSERVATIONS_URL, json=request)
+    metadata, series = parse_observations_json(resp.json(), validated=validated)
+    return series_info(metadata, series)
+
+
+def series_info(metadata, series):
+    """return a series with the names and units of the metadata"""
     return {
         "name": metadata['standard_name'].replace('_', ' '),
         "units": metadata['Eenheid']['Code'],
@@ -224,55 +519,228 @@ def get_series(row, start_time, end_time, validated=False):
     }
 
 
+def fetch_series(row, start_time, end_time):
+    """get timeseries for a given row, through the series cache and the local store
+
+    Only the periods that are not cached or stored are fetched from ddl.
+    """
+    key = (row.code, row.quantity)
+
+    def fetch_ddl(start, end):
+        try:
+            return get_series(row, start, end)
+        except NoDataException:
+            return None
+
+    def fetch_stored(start, end):
+        if store is None:
+            return fetch_ddl(start, end)
+        return store.get(key, start, end, fetch_ddl)
+
+    def fetch_once(start, end):
+        # concurrent requests for a period share one fetch, other processes wait for it and
+        # get the recent part, which the store doesn't cover, from the published result
+        return flights.do(
+            key + (start, end),
+            lambda: fetch_stored(start, end),
+            lock_key=key + (start, end),
+            publish=True
+        )
+
+    series = series_cache.get(key, start_time, end_time, fetch_once)
+    if series is None:
+        raise NoDataException('no data for %s at %s' % (row.quantity, row.code))
+    return series
+
+
+def concat_series(chunks):
+    """return the series of consecutive chunks as one series"""
+    series = dict(chunks[-1])
+    data = pd.concat([chunk['data'] for chunk in chunks], ignore_index=True)
+    # chunks share their bounds
+    data = data.drop_duplicates('dateTime', keep='last').sort_values('dateTime')
+    series['data'] = data.reset_index(drop=True)
+    return series
+
+
 def get_data(station, quantity, start_time, end_time):
-    """get data for station"""
-    metadata = get_metadata()
-    metadata_df = metadata2df(metadata, quantity=quantity)
+    """get data for station
 
+    Long periods are split in chunks of chunk_size. The chunks of all
+    series are fetched concurrently and cached per chunk, so a failed
+    request only refetches the failed chunks.
+    """
     series_list = []
-    available_series = metadata_df[metadata_df.code == station]
-    for idx, row in available_series.iterrows():
-        try:
-            series = get_series(row, start_time, end_time)
-        except NoDataException as e:
-            logging.exception('no data for %s at %s', row.quantity, row.code)
+    available_series = get_station_index().select(code=station, quantity=quantity)
+    rows = [row for idx, row in available_series.iterrows()]
+    periods = intervals.split(start_time, end_time, chunk_size)
+    # one flat list of tasks, fetch_series does not wait for the executor
+    futures = [
+        [executor.submit(fetch_series, row, start, end) for start, end in periods]
+        for row in rows
+    ]
+    for row, row_futures in zip(rows, futures):
+        chunks = []
+        for future in row_futures:
+            try:
+                chunks.append(future.result())
+            except NoDataException:
+                continue
+        if not chunks:
+            logger.info('no data for %s at %s', row.quantity, row.code)
             continue
-        series_list.append(series)
+        series_list.append(concat_series(chunks))
     return {
         "series": series_list
     }
 
 
-@cache.region('short_term', 'rws')
-def get_stations_per_quantity(quantity):
-    metadata = get_metadata()
-    metadata_df = metadata2df(metadata, quantity=quantity)
-    fc = df2geojson(metadata_df)
+def parse_observations_body(body, validated=False):
+    """return the series of a complete OphalenWaarnemingen response body"""
+    if ijson_available():
+        metadata, series = parse_observations(io.BytesIO(body), validated=validated)
+    else:
+        metadata, series = parse_observations_json(json.loads(body.decode('utf-8')), validated=validated)
+    return series_info(metadata, series)
 
-    # serializa/deserialize to get rid of custom types
-    response = geojson.loads(geojson.dumps(fc, cls=CustomEncoder))
-    return response
+
+async def get_series_async(aio_client, row, start_time, end_time, validated=False):
+    """get timeseries for a given row, with an asyncio client, see stathakis.aio
+
+    The response is parsed in the default executor of the loop.
+    """
+    request = observations_request(row, start_time, end_time)
+    logger.debug('Getting url with data %s', request)
+    body = await aio_client.post(OBSERVATIONS_URL, json=request)
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, parse_observations_body, body, validated)
+
+
+async def fetch_series_async(aio_client, row, start_time, end_time):
+    """get timeseries for a given row through the series cache and the local store, like fetch_series
+
+    The local store is read and written in the default executor of the loop.
+    """
+    key = (row.code, row.quantity)
+    loop = asyncio.get_event_loop()
+
+    async def fetch_ddl(start, end):
+        try:
+            return await get_series_async(aio_client, row, start, end)
+        except NoDataException:
+            return None
+
+    async def fetch_stored(start, end):
+        if store is None:
+            return await fetch_ddl(start, end)
+        missing = await loop.run_in_executor(None, store.missing, key, start, end)
+        for start_seconds, end_seconds in missing:
+            series = await fetch_ddl(
+                pd.Timestamp(start_seconds, unit='s', tz='UTC').to_pydatetime(),
+                pd.Timestamp(end_seconds, unit='s', tz='UTC').to_pydatetime()
+            )
+            await loop.run_in_executor(None, store.insert, key, start_seconds, end_seconds, series)
+        return await loop.run_in_executor(None, store.read, key, start, end)
+
+    for start, end in series_cache.missing(key, start_time, end_time):
+        start, end = start.to_pydatetime(), end.to_pydatetime()
+        # concurrent requests for a period share one fetch, other processes wait for it
+        series = await flights.do_async(
+            key + (start, end),
+            functools.partial(fetch_stored, start, end),
+            lock_key=key + (start, end),
+            publish=True
+        )
+        series_cache.insert(key, start, end, series)
+    series = series_cache.read(key, start_time, end_time)
+    if series is None:
+        raise NoDataException('no data for %s at %s' % (row.quantity, row.code))
+    return series
+
+
+async def get_data_async(aio_client, station, quantity, start_time, end_time):
+    """get data for station, like get_data, the chunks of all series are awaited concurrently"""
+    loop = asyncio.get_event_loop()
+    # the first request might load the catalogue
+    station_index = await loop.run_in_executor(None, get_station_index)
+    available_series = station_index.select(code=station, quantity=quantity)
+    rows = [row for idx, row in available_series.iterrows()]
+    periods = intervals.split(start_time, end_time, chunk_size)
+    results = await asyncio.gather(*[
+        fetch_series_async(aio_client, row, start, end)
+        for row in rows
+        for start, end in periods
+    ], return_exceptions=True)
+    series_list = []
+    for i, row in enumerate(rows):
+        chunks = []
+        for result in results[i * len(periods):(i + 1) * len(periods)]:
+            if isinstance(result, NoDataException):
+                continue
+            if isinstance(result, BaseException):
+                # also a cancelled fetch
+                raise result
+            chunks.append(result)
+        if not chunks:
+            logger.info('no data for %s at %s', row.quantity, row.code)
+            continue
+        series_list.append(concat_series(chunks))
+    return {
+        "series": series_list
+    }
+
+
+def get_stations_per_quantity(quantity, bbox=None, near=None, k=5):
+    return get_station_index().feature_collection(quantity=quantity, bbox=bbox, near=near, k=k)
 
 
-@cache.region('short_term', 'rws')
 def get_station_info(station):
-    metadata = get_metadata()
-    metadata_df = metadata2df(metadata)
-    selected_df = metadata_df[metadata_df.code == str(station)]
-    fc = df2geojson(selected_df)
-    # serializa/deserialize to get rid of custom types
-    response = json.loads(geojson.dumps(fc, cls=CustomEncoder))
-    return response
+    return get_station_index().feature_collection(code=str(station))
 
 
-@cache.region('short_term', 'rws')
-def get_station_measurements(station, quantity, start_time=None, end_time=None):
-    now = datetime.datetime.now(UTC)
+def default_period(start_time=None, end_time=None):
+    """return the period of a request, two days around now by default
+
+    Now is rounded down to the minute, so concurrent requests ask for the
+    same period.
+    """
+    now = datetime.datetime.now(UTC).replace(second=0, microsecond=0)
     two_days = datetime.timedelta(days=2)
     if start_time is None:
         start_time = (now - two_days)
     if end_time is None:
         end_time = (now + two_days)
-    data = get_data(station, quantity=quantity, start_time=start_time, end_time=end_time)
-    response = json.loads(json.dumps(data, cls=CustomEncoder))
-    return response
+    return start_time, end_time
+
+
+@cache.region('short_term', 'rws')
+def get_station_measurements(station, quantity, start_time=None, end_time=None):
+    start_time, end_time = default_period(start_time, end_time)
+    data = flights.do(
+        ('measurements', station, quantity, start_time, end_time),
+        lambda: get_data(station, quantity=quantity, start_time=start_time, end_time=end_time)
+    )
+    return data
+
+
+async def get_station_measurements_async(aio_client, station, quantity, start_time=None, end_time=None):
+    """return the measurements of a station with an asyncio client, see stathakis.aio
+
+    Repeated requests are served from the short_term region, like
+    get_station_measurements, and the series cache. The region is read and
+    written in the default executor of the loop.
+    """
+    start_time, end_time = default_period(start_time, end_time)
+    key = ' '.join(str(part) for part in (station, quantity, start_time, end_time))
+    loop = asyncio.get_event_loop()
+    try:
+        return await loop.run_in_executor(None, measurements_cache.get, key)
+    except KeyError:
+        pass
+
+    async def fetch():
+        data = await get_data_async(aio_client, station, quantity=quantity, start_time=start_time, end_time=end_time)
+        await loop.run_in_executor(None, measurements_cache.put, key, data)
+        return data
+
+    return await flights.do_async(('measurements', station, quantity, start_time, end_time), fetch)
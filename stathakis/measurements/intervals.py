@@ -0,0 +1,202 @@
+"""Helpers for sets of (start, end) intervals, used by the series caches."""
+import collections
+import threading
+import time
+
+import pandas as pd
+
+
+def merge(intervals):
+    """merge overlapping and adjacent (start, end) intervals"""
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def subtract(intervals, start, end):
+    """return the parts of (start, end) that are not covered by the merged intervals"""
+    missing = []
+    current = start
+    for interval_start, interval_end in intervals:
+        if interval_end < current:
+            continue
+        if interval_start > end:
+            break
+        if interval_start > current:
+            missing.append((current, interval_start))
+        current = max(current, interval_end)
+        if current >= end:
+            break
+    if current < end:
+        missing.append((current, end))
+    return missing
+
+
+def split(start_time, end_time, size):
+    """split (start_time, end_time) in periods of at most size (a timedelta), aligned to multiples of size
+
+    Aligned periods are the same for overlapping requests, so they can be
+    cached and retried per period. Adjacent periods share their bounds.
+    """
+    start_time = utc(start_time)
+    end_time = utc(end_time)
+    size = pd.Timedelta(size)
+    epoch = pd.Timestamp('1970-01-01', tz='UTC')
+    if start_time >= end_time:
+        return [(start_time.to_pydatetime(), end_time.to_pydatetime())]
+    periods = []
+    start = start_time
+    while start < end_time:
+        end = min(epoch + ((start - epoch) // size + 1) * size, end_time)
+        periods.append((start.to_pydatetime(), end.to_pydatetime()))
+        start = end
+    return periods
+
+
+def utc(dt):
+    """return dt as a UTC timestamp, naive datetimes are assumed to be in UTC"""
+    dt = pd.Timestamp(dt)
+    if dt.tzinfo is None:
+        return dt.tz_localize('UTC')
+    return dt.tz_convert('UTC')
+
+
+class IntervalCache(object):
+    """In-memory cache of series that serves sub-ranges of fetched periods.
+
+    Series are cached per key with the periods that were fetched. A request
+    is answered with a slice of the cached data and only the periods that
+    are not covered are fetched. Data within `volatile` seconds of now can
+    still change, periods that touch it are fetched again after
+    `volatile_expire` seconds. The least recently used series are dropped
+    when the data frames take more than `max_bytes`.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, volatile=7200, volatile_expire=60):
+        self.max_bytes = max_bytes
+        self.volatile = pd.Timedelta(seconds=volatile)
+        self.volatile_expire = volatile_expire
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.RLock()
+
+    def stable_until(self, fetched):
+        """return the time before which the data that was fetched at fetched (seconds) doesn't change"""
+        return pd.Timestamp(fetched, unit='s', tz='UTC') - self.volatile
+
+    def coverage(self, key):
+        """return the merged periods of key that are still valid"""
+        now = time.time()
+        valid = []
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return []
+            self.entries.move_to_end(key)
+            for start, end, fetched in entry['coverage']:
+                if now - fetched > self.volatile_expire:
+                    # drop the part that was volatile when it was fetched
+                    end = min(end, self.stable_until(fetched))
+                if start < end:
+                    valid.append((start, end))
+        return merge(valid)
+
+    def missing(self, key, start_time, end_time):
+        """return the periods between start_time and end_time that are not cached"""
+        return subtract(self.coverage(key), utc(start_time), utc(end_time))
+
+    def insert(self, key, start_time, end_time, series=None):
+        """add a fetched series and mark the period as fetched"""
+        interval = (utc(start_time), utc(end_time), time.time())
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                entry = {"info": None, "data": None, "coverage": [], "nbytes": 0}
+            self.nbytes -= entry['nbytes']
+            if series is not None:
+                data = series['data']
+                if entry['data'] is not None:
+                    data = pd.concat([entry['data'], data], ignore_index=True)
+                    data = data.drop_duplicates('dateTime', keep='last').sort_values('dateTime')
+                    data = data.reset_index(drop=True)
+                entry['data'] = data
+                entry['info'] = {
+                    name: value
+                    for name, value in series.items()
+                    if name != 'data'
+                }
+                entry['nbytes'] = int(data.memory_usage(deep=True).sum())
+            entry['coverage'] = self.compact(entry['coverage'], interval)
+            self.entries[key] = entry
+            self.nbytes += entry['nbytes']
+            self.evict(keep=key)
+
+    def compact(self, coverage, interval):
+        """return the coverage with a newly fetched (start, end, fetched) interval
+
+        The parts that were stable when they were fetched are merged. The
+        new interval replaces the overlapping volatile parts, which keep
+        their own fetch time. Repeated requests for recent data don't grow
+        the coverage.
+        """
+        start, end, fetched = interval
+        stable = []
+        volatile = []
+        for interval_start, interval_end, interval_fetched in coverage:
+            recent = self.stable_until(interval_fetched)
+            if interval_start < min(interval_end, recent):
+                stable.append((interval_start, min(interval_end, recent)))
+            if interval_end > recent:
+                # the parts that are not fetched again
+                for part in subtract([(start, end)], max(interval_start, recent), interval_end):
+                    volatile.append(part + (interval_fetched, ))
+        recent = self.stable_until(fetched)
+        if start < min(end, recent):
+            stable.append((start, min(end, recent)))
+        if end > recent:
+            volatile.append((max(start, recent), end, fetched))
+        # the stable parts end before the latest fetch time minus volatile
+        compacted = [
+            (stable_start, stable_end, fetched)
+            for stable_start, stable_end in merge(stable)
+        ]
+        return compacted + sorted(volatile)
+
+    def evict(self, keep=None):
+        """drop the least recently used series until the cache fits in max_bytes"""
+        with self.lock:
+            for key in list(self.entries.keys()):
+                if self.nbytes <= self.max_bytes:
+                    break
+                if key == keep:
+                    continue
+                entry = self.entries.pop(key)
+                self.nbytes -= entry['nbytes']
+
+    def read(self, key, start_time, end_time):
+        """return the cached series between start_time and end_time, None if unknown"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry['info'] is None:
+                return None
+            info = entry['info']
+            data = entry['data']
+        times = data['dateTime']
+        selected = data[(times >= utc(start_time)) & (times <= utc(end_time))]
+        series = dict(info)
+        series['data'] = selected.reset_index(drop=True)
+        return series
+
+    def get(self, key, start_time, end_time, fetch):
+        """return the series between start_time and end_time, fetch(start, end) the missing parts
+
+        fetch returns a series or None if there is no data.
+        """
+        for start, end in self.missing(key, start_time, end_time):
+            series = fetch(start.to_pydatetime(), end.to_pydatetime())
+            self.insert(key, start, end, series)
+        return self.read(key, start_time, end_time)
@@ -1,13 +1,13 @@
 import logging
 import pathlib
 import json
+import threading
+import time
 
 import netCDF4
 import numpy as np
 import pandas as pd
 
-from ..utils import CustomEncoder
-
 logger = logging.getLogger(__name__)
 
 
@@ -32,74 +32,556 @@ def check(u_urls, v_urls):
     assert ds_v.variables['time'].units == 'hours since 1800-01-01 00:00:0.0'
 
 
-def get_grid_info(data_dir):
-    info = {}
-    data_dir = pathlib.Path(data_dir)
-    v_urls = list(sorted(data_dir.glob('vwnd.10m.gauss.*.nc')))
-    u_urls = list(sorted(data_dir.glob('uwnd.10m.gauss.*.nc')))
-    info['urls'] = u_urls + v_urls
-    with netCDF4.MFDataset(u_urls, aggdim='time') as ds_u:
-        attrs = ds_u.ncattrs()
-        for attr in attrs:
-            info[attr] = getattr(ds_u, attr)
-    with netCDF4.MFDataset(v_urls, aggdim='time') as ds_v:
-        attrs = ds_v.ncattrs()
-        for attr in attrs:
-            info[attr] = getattr(ds_v, attr)
-    return info
+# file patterns and variable names of the yearly NCEP files
+PATTERNS = {
+    'u': 'uwnd.10m.gauss.*.nc',
+    'v': 'vwnd.10m.gauss.*.nc'
+}
+VARIABLES = {
+    'u': 'uwnd',
+    'v': 'vwnd'
+}
+# don't use num2date from netcdf4, too slow
+T0 = np.datetime64('1800-01-01', 'm')
+# point-major copies of the grids, see build_point_cache
+CACHE_DIR = 'cache'
+# number of time steps read at once for bounding boxes
+BBOX_BLOCK_SIZE = 240
+# variables of the wind series, speed and direction are derived from u and v
+WIND_VARIABLES = ('u', 'v', 'speed', 'direction')
+# periods of resampled series
+RESAMPLE_RULES = {
+    'hourly': pd.Timedelta(hours=1),
+    'daily': pd.Timedelta(days=1),
+    'monthly': 'MS'
+}
+
+
+class GridIndex(object):
+    """Lookup of grid cells, built once per opened dataset.
+
+    The latitudes can be sorted in either direction (the Gaussian NCEP
+    latitudes run from north to south), the longitudes are ascending and
+    span the globe. Points are looked up with a binary search on the
+    sorted axes. Longitudes are wrapped to the range of the grid, so -10
+    and 350 are the same location.
+    """
+
+    def __init__(self, lat, lon):
+        self.lat = np.asarray(lat, dtype='float64')
+        self.lon = np.asarray(lon, dtype='float64')
+        self.lat_order = np.argsort(self.lat, kind='mergesort')
+        self.lat_sorted = self.lat[self.lat_order]
+        # the first column follows the last one
+        self.lon_wrapped = np.append(self.lon, self.lon[0] + 360)
+
+    def wrap(self, lons):
+        """return longitudes in the range of the grid [lon[0], lon[0] + 360)"""
+        lon0 = self.lon[0]
+        return (np.asarray(lons, dtype='float64') - lon0) % 360 + lon0
+
+    def lat_cells(self, lats):
+        """return the rows below and above lats (in sorted order) and the fraction between them"""
+        lats = np.asarray(lats, dtype='float64')
+        upper = np.clip(np.searchsorted(self.lat_sorted, lats), 1, len(self.lat_sorted) - 1)
+        lower = upper - 1
+        span = self.lat_sorted[upper] - self.lat_sorted[lower]
+        # points beyond the outer rows get the outer row
+        fraction = np.clip((lats - self.lat_sorted[lower]) / span, 0, 1)
+        return lower, upper, fraction
+
+    def lon_cells(self, lons):
+        """return the columns west and east of lons and the fraction between them"""
+        lons = self.wrap(lons)
+        n = len(self.lon)
+        upper = np.clip(np.searchsorted(self.lon_wrapped, lons, side='right'), 1, n)
+        lower = upper - 1
+        span = self.lon_wrapped[upper] - self.lon_wrapped[lower]
+        fraction = (lons - self.lon_wrapped[lower]) / span
+        return lower, upper % n, fraction
+
+    def nearest(self, lats, lons):
+        """return the indices of the nearest grid cells of all points"""
+        lat_lower, lat_upper, lat_fraction = self.lat_cells(lats)
+        lon_lower, lon_upper, lon_fraction = self.lon_cells(lons)
+        lat_idx = self.lat_order[np.where(lat_fraction > 0.5, lat_upper, lat_lower)]
+        lon_idx = np.where(lon_fraction > 0.5, lon_upper, lon_lower)
+        return lat_idx, lon_idx
+
+    def weights(self, lats, lons):
+        """return the indices of the 4 surrounding cells of all points and their bilinear weights
+
+        All arrays have shape (n_points, 4).
+        """
+        lat_lower, lat_upper, fy = self.lat_cells(lats)
+        lon_lower, lon_upper, fx = self.lon_cells(lons)
+        lat_lower = self.lat_order[lat_lower]
+        lat_upper = self.lat_order[lat_upper]
+        lat_idx = np.stack([lat_lower, lat_lower, lat_upper, lat_upper], axis=-1)
+        lon_idx = np.stack([lon_lower, lon_upper, lon_lower, lon_upper], axis=-1)
+        weights = np.stack([
+            (1 - fy) * (1 - fx),
+            (1 - fy) * fx,
+            fy * (1 - fx),
+            fy * fx
+        ], axis=-1)
+        return lat_idx, lon_idx, weights
+
+    def bbox(self, lat_min, lat_max, lon_min, lon_max):
+        """return the rows, the column slices and the longitudes within a bounding box
+
+        The rows are a slice. A box that crosses the edge of the grid has
+        two column slices, the longitudes are in the range of the box.
+        """
+        start = np.searchsorted(self.lat_sorted, lat_min, side='left')
+        stop = np.searchsorted(self.lat_sorted, lat_max, side='right')
+        rows = self.lat_order[start:stop]
+        if not len(rows):
+            raise ValueError("no grid cells in bounding box")
+        lat_slice = slice(rows.min(), rows.max() + 1)
+        if lon_max - lon_min >= 360:
+            lon_min, lon_max = self.lon[0], self.lon[-1]
+        west = self.wrap(lon_min)
+        east = west + (lon_max - lon_min)
+        column_slices = []
+        lons = []
+        for offset in (0, 360):
+            columns = np.flatnonzero((self.lon + offset >= west) & (self.lon + offset <= east))
+            if len(columns):
+                column_slices.append(slice(columns[0], columns[-1] + 1))
+                lons.append(self.lon[columns] + offset + (lon_min - west))
+        if not column_slices:
+            raise ValueError("no grid cells in bounding box")
+        return lat_slice, column_slices, np.concatenate(lons)
+
+
+class GridStore(object):
+    """Keep the NCEP wind files open between requests.
+
+    The yearly files are opened once and the time, lat and lon axes are
+    decoded once. The modification times of the files are checked every
+    `check_interval` seconds and the files are reopened when a yearly file
+    is added or changed. Use the lock when reading from the datasets,
+    netCDF4 is not thread safe.
+    """
+
+    def __init__(self, data_dir, check_interval=60):
+        self.data_dir = pathlib.Path(data_dir)
+        self.check_interval = check_interval
+        self.lock = threading.RLock()
+        self.datasets = {}
+        self.point_cache = {}
+        self.urls = {}
+        self.mtimes = {}
+        self.cache_mtimes = {}
+        self.checked = None
+        self.refresh(force=True)
 
+    def find_urls(self):
+        """return the yearly files per variable"""
+        return {
+            key: list(sorted(self.data_dir.glob(pattern)))
+            for key, pattern
+            in PATTERNS.items()
+        }
 
-def get_measurements(data_dir, quantity, lat, lon, start_time, end_time):
-    """return data for a given location"""
+    def refresh(self, force=False):
+        """reopen the datasets if files were added or changed"""
+        now = time.monotonic()
+        if not force and self.checked is not None and now - self.checked < self.check_interval:
+            return False
+        with self.lock:
+            self.checked = now
+            urls = self.find_urls()
+            mtimes = {
+                str(url): url.stat().st_mtime
+                for key in urls
+                for url in urls[key]
+            }
+            cache_mtimes = {
+                str(url): url.stat().st_mtime
+                for url in (self.data_dir / CACHE_DIR).glob('*.json')
+            }
+            if not force and mtimes == self.mtimes and cache_mtimes == self.cache_mtimes:
+                return False
+            logger.info("opening data in %s, found urls: %s", self.data_dir, urls)
+            self.open(urls, mtimes)
+            self.mtimes = mtimes
+            self.cache_mtimes = cache_mtimes
+            return True
 
+    def open(self, urls, mtimes):
+        """open the datasets and decode the axes"""
+        self.close()
+        for key, var_urls in urls.items():
+            self.datasets[key] = netCDF4.MFDataset(var_urls, aggdim='time')
+            point_cache = open_point_cache(self.data_dir, key, mtimes)
+            if point_cache is not None:
+                self.point_cache[key] = point_cache
+        self.urls = urls
+        # use variables from u
+        ds_u = self.datasets['u']
+        self.t = T0 + ds_u.variables['time'][:].astype('timedelta64[h]')
+        self.lat = ds_u.variables['lat'][:]
+        self.lon = ds_u.variables['lon'][:]
+        self.index = GridIndex(self.lat, self.lon)
+        self.attrs = {}
+        self.names = {}
+        self.units = {}
+        for key, ds in self.datasets.items():
+            for attr in ds.ncattrs():
+                self.attrs[attr] = getattr(ds, attr)
+            var = ds.variables[VARIABLES[key]]
+            self.names[key] = var.long_name
+            self.units[key] = var.units
+
+    def close(self):
+        """close all open datasets"""
+        with self.lock:
+            for ds in self.datasets.values():
+                ds.close()
+            self.datasets = {}
+            self.point_cache = {}
+
+    def nearest(self, lats, lons):
+        """return the indices of the nearest grid cells of all points"""
+        return self.index.nearest(lats, lons)
+
+    def time_slice(self, start_time, end_time):
+        """return the slice of the time axis between start_time and end_time"""
+        t_range = np.asarray([start_time, end_time], 'datetime64[m]')
+        t_start_idx, t_end_idx = np.searchsorted(self.t, t_range)
+        return slice(t_start_idx, t_end_idx)
+
+    def read_points(self, lat_idx, lon_idx, t_slice):
+        """read the series of the grid cells (lat_idx[i], lon_idx[i])
+
+        Returns an array of shape (n_points, n_times) per variable. All cells
+        are read in one pass over the files.
+        """
+        data = {}
+        for key, ds in self.datasets.items():
+            if key in self.point_cache:
+                # time is contiguous in the point cache
+                data[key] = np.asarray(self.point_cache[key][lat_idx, lon_idx, t_slice])
+                continue
+            # read the union of rows and columns in one go and pick the cells
+            lat_unique, lat_pos = np.unique(lat_idx, return_inverse=True)
+            lon_unique, lon_pos = np.unique(lon_idx, return_inverse=True)
+            values = ds.variables[VARIABLES[key]][t_slice, lat_unique, lon_unique]
+            values = np.ma.filled(np.ma.asarray(values, dtype='f4'), np.nan)
+            data[key] = values[:, lat_pos, lon_pos].T
+        return data
+
+    def read_interpolated(self, lats, lons, t_slice):
+        """read the series at (lats[i], lons[i]), bilinearly interpolated between the surrounding cells"""
+        lat_idx, lon_idx, weights = self.index.weights(lats, lons)
+        data = self.read_points(lat_idx.ravel(), lon_idx.ravel(), t_slice)
+        return {
+            key: np.einsum('pc,pct->pt', weights, values.reshape(weights.shape + (-1, ))).astype('f4')
+            for key, values in data.items()
+        }
+
+    @property
+    def end_time(self):
+        """the last time step of the grid, a UTC datetime"""
+        return pd.Timestamp(self.t[-1]).tz_localize('UTC').to_pydatetime()
+
+    @property
+    def modified(self):
+        """the last modification time of the files"""
+        return max(self.mtimes.values()) if self.mtimes else None
+
+
+def point_cache_paths(data_dir, key):
+    """return the paths of the array and header of a point-major cache"""
+    cache_dir = pathlib.Path(data_dir) / CACHE_DIR
+    name = VARIABLES[key] + '.point'
+    return cache_dir / (name + '.npy'), cache_dir / (name + '.json')
+
+
+def open_point_cache(data_dir, key, mtimes):
+    """open the point-major cache of a variable as a memory map
+
+    Returns None if there is no cache or if it was built from other files.
+    """
+    array_path, header_path = point_cache_paths(data_dir, key)
+    if not header_path.exists():
+        return None
+    with header_path.open() as f:
+        header = json.load(f)
+    # compare by file name, the data dir can be relative
+    sources = {
+        pathlib.Path(url).name: mtime
+        for url, mtime in mtimes.items()
+        if pathlib.Path(url).name.startswith(VARIABLES[key] + '.')
+    }
+    if header['sources'] != sources:
+        logger.warning("point cache %s is outdated, rebuild it with stathakis-cache", array_path)
+        return None
+    return np.load(str(array_path), mmap_mode='r')
+
+
+def build_point_cache(data_dir):
+    """rewrite the grids with time as the fastest running dimension
+
+    The grids are stored time major, so a point series reads one value from
+    every 2D field. The cache is stored as a (lat, lon, time) float32 array,
+    a point series is one contiguous read from the memory map.
+    """
     data_dir = pathlib.Path(data_dir)
-    v_urls = list(sorted(data_dir.glob('vwnd.10m.gauss.*.nc')))
-    u_urls = list(sorted(data_dir.glob('uwnd.10m.gauss.*.nc')))
-    logger.info("reading data in %s, found urls: %s and %s", data_dir, u_urls, v_urls)
-    # get all data required to find correct dataset
-    data = {}
-    with netCDF4.MFDataset(u_urls, aggdim='time') as ds_u:
-        # lookup variables in both files
-        t_u = ds_u.variables['time'][:]
-        lon_u = ds_u.variables['lon'][:]
-        lat_u = ds_u.variables['lat'][:]
+    store = GridStore(data_dir)
+    (data_dir / CACHE_DIR).mkdir(exist_ok=True)
+    for key, urls in store.urls.items():
+        array_path, header_path = point_cache_paths(data_dir, key)
+        if header_path.exists():
+            header_path.unlink()
+        tmp_path = array_path.with_suffix('.tmp')
+        shape = (len(store.lat), len(store.lon), len(store.t))
+        point_cache = np.lib.format.open_memmap(str(tmp_path), mode='w+', dtype='<f4', shape=shape)
+        offset = 0
+        # one yearly file at a time, to limit memory use
+        for url in urls:
+            logger.info("transposing %s", url)
+            with netCDF4.Dataset(str(url)) as ds:
+                values = ds.variables[VARIABLES[key]][:]
+            n = values.shape[0]
+            values = np.ma.filled(values.astype('f4'), np.nan)
+            point_cache[:, :, offset:offset + n] = values.transpose(1, 2, 0)
+            offset += n
+        point_cache.flush()
+        del point_cache
+        tmp_path.replace(array_path)
+        header = {
+            "variable": VARIABLES[key],
+            "shape": shape,
+            "sources": {
+                url.name: url.stat().st_mtime
+                for url in urls
+            }
+        }
+        # write the header last, it marks the cache as complete
+        with header_path.open('w') as f:
+            json.dump(header, f)
+    store.close()
 
-    # don't use num2date from netcdf4, too slow
-    t0 = np.datetime64('1800-01-01', 'm')
-
-    # use variables from u
-    data['t'] = t0 + t_u.astype('timedelta64[h]')
-    data['lon'] = lon_u
-    data['lat'] = lat_u
-    lat_idx = np.argmin(np.abs(data['lat'] - lat))
-    lon_idx = np.argmin(np.abs(data['lon'] - lon))
-    data['lat'][lat_idx], data['lon'][lon_idx], (lat_idx, lon_idx)
-    t_range = np.asarray([start_time, end_time], 'datetime64[m]')
-    t_start_idx, t_end_idx = np.searchsorted(data['t'], t_range)
-    t_start_idx, t_end_idx
-
-    # slice
-    s = np.s_[t_start_idx:t_end_idx, lat_idx, lon_idx]
-
-    names = {}
-    units = {}
-    with netCDF4.MFDataset(u_urls, aggdim='time') as ds_u:
-        data['u'] = ds_u.variables['uwnd'][s]
-        names['u'] = ds_u.variables['uwnd'].long_name
-        units['u'] = ds_u.variables['uwnd'].units
-    with netCDF4.MFDataset(v_urls, aggdim='time') as ds_v:
-        data['v'] = ds_v.variables['vwnd'][s]
-        names['v'] = ds_u.variables['uwnd'].long_name
-        units['v'] = ds_u.variables['uwnd'].units
 
+# grid stores, shared between requests, per data directory
+stores = {}
+stores_lock = threading.Lock()
+
+
+def get_store(data_dir):
+    """return the shared grid store for data_dir, open it on first use"""
+    key = str(pathlib.Path(data_dir).resolve())
+    with stores_lock:
+        if key not in stores:
+            stores[key] = GridStore(data_dir)
+    store = stores[key]
+    store.refresh()
+    return store
+
+
+def after_fork():
+    """reopen the shared stores in a forked process, the file handles of the parent can't be shared"""
+    global stores_lock
+    stores_lock = threading.Lock()
+    for store in stores.values():
+        store.lock = threading.RLock()
+        store.refresh(force=True)
+
+
+def get_modified(data_dir):
+    """return the last modification time of the grid files, the version of the grid"""
+    return get_store(data_dir).modified
+
+
+def get_end_time(data_dir):
+    """return the last time step of the grid, later times are added to the files"""
+    return get_store(data_dir).end_time
+
+
+def get_grid_info(data_dir):
+    store = get_store(data_dir)
+    info = {}
+    with store.lock:
+        info['urls'] = [str(url) for url in store.urls['u'] + store.urls['v']]
+        info.update(store.attrs)
+    return info
+
+
+def series_frame(t, u, v):
+    """return a data frame with the series of one location"""
     series = pd.DataFrame(data=dict(
-                dateTime=data['t'][t_start_idx:t_end_idx],
-                u=data['u'],
-                v=data['v']
+                dateTime=t,
+                u=u,
+                v=v
     ))
-    # make sure we serialize to json
-    series = json.loads(json.dumps(series, cls=CustomEncoder))
+    return series
+
+
+def wind_direction(u, v):
+    """return the direction the wind comes from, in degrees clockwise from north"""
+    return np.degrees(np.arctan2(-u, -v)) % 360
+
+
+def aggregate_resampled(resampler, aggregate):
+    """aggregate resampled series by mean, min, max, median or a percentile (p90)"""
+    if aggregate in ('mean', 'min', 'max', 'median'):
+        return getattr(resampler, aggregate)()
+    if aggregate.startswith('p') and aggregate[1:].isdigit() and 0 <= int(aggregate[1:]) <= 100:
+        return resampler.quantile(int(aggregate[1:]) / 100)
+    raise ValueError("unknown aggregate %s" % (aggregate, ))
+
+
+def derive(series, variables=None, resample=None, aggregate='mean'):
+    """return the series with the requested variables, optionally aggregated per period
+
+    The variables are u, v and the derived speed and direction. Resampled
+    series contain one row per period (see RESAMPLE_RULES) with values,
+    the direction is the direction of the mean wind vector in a period.
+    """
+    if variables is None and resample is None:
+        return series
+    if variables is None:
+        variables = ['u', 'v']
+    unknown = set(variables) - set(WIND_VARIABLES)
+    if unknown:
+        raise ValueError("unknown variables %s" % (sorted(unknown), ))
+    frame = series[['dateTime', 'u', 'v']].copy()
+    frame['speed'] = np.hypot(frame['u'].values, frame['v'].values)
+    if resample is None:
+        frame['direction'] = wind_direction(frame['u'].values, frame['v'].values)
+        return frame[['dateTime'] + list(variables)]
+    if resample not in RESAMPLE_RULES:
+        raise ValueError("unknown resample period %s" % (resample, ))
+    resampler = frame.set_index('dateTime').resample(RESAMPLE_RULES[resample])
+    aggregated = aggregate_resampled(resampler, aggregate)
+    means = aggregated if aggregate == 'mean' else resampler.mean()
+    aggregated['direction'] = wind_direction(means['u'].values, means['v'].values)
+    # periods without data
+    aggregated = aggregated.dropna(how='all')
+    return aggregated.reset_index()[['dateTime'] + list(variables)]
+
+
+def get_measurements(
+        data_dir,
+        quantity,
+        lat,
+        lon,
+        start_time,
+        end_time,
+        interpolate=False,
+        variables=None,
+        resample=None,
+        aggregate='mean'
+):
+    """return data for a given location, of the nearest cell or interpolated
+
+    See derive for the variables, resample and aggregate options.
+    """
+    store = get_store(data_dir)
+
+    # read axes and data under the lock, the store might be reopened
+    with store.lock:
+        t_slice = store.time_slice(start_time, end_time)
+        t = store.t[t_slice]
+        if interpolate:
+            data = store.read_interpolated([lat], [lon], t_slice)
+        else:
+            lat_idx, lon_idx = store.nearest([lat], [lon])
+            data = store.read_points(lat_idx, lon_idx, t_slice)
+
+    series = series_frame(t, data['u'][0], data['v'][0])
+    series = derive(series, variables, resample, aggregate)
     response = {
         "series": series
     }
     return response
+
+
+def get_measurements_batch(
+        data_dir,
+        quantity,
+        points,
+        start_time,
+        end_time,
+        interpolate=False,
+        variables=None,
+        resample=None,
+        aggregate='mean'
+):
+    """return data for a list of (lon, lat) locations, see get_measurements for the options"""
+    store = get_store(data_dir)
+    points = np.asarray(points, dtype='float64').reshape(-1, 2)
+
+    with store.lock:
+        t_slice = store.time_slice(start_time, end_time)
+        t = store.t[t_slice]
+        if interpolate:
+            data = store.read_interpolated(points[:, 1], points[:, 0], t_slice)
+            lats = points[:, 1]
+            lons = points[:, 0]
+        else:
+            lat_idx, lon_idx = store.nearest(points[:, 1], points[:, 0])
+            data = store.read_points(lat_idx, lon_idx, t_slice)
+            lats = store.lat[lat_idx]
+            lons = store.lon[lon_idx]
+
+    results = []
+    for i, point in enumerate(points):
+        results.append({
+            "point": point.tolist(),
+            "lat": float(lats[i]),
+            "lon": float(lons[i]),
+            "series": derive(series_frame(t, data['u'][i], data['v'][i]), variables, resample, aggregate)
+        })
+    response = {
+        "points": results
+    }
+    return response
+
+
+def get_bbox(data_dir, quantity, lat_min, lat_max, lon_min, lon_max, start_time, end_time):
+    """return the u/v cube within a bounding box
+
+    The cube is read lazily, in blocks of BBOX_BLOCK_SIZE time steps, see
+    stathakis.responses for the layout.
+    """
+    store = get_store(data_dir)
+
+    with store.lock:
+        # the rows are contiguous, the columns are split at the edge of the grid
+        lat_slice, lon_slices, lon = store.index.bbox(lat_min, lat_max, lon_min, lon_max)
+        t_slice = store.time_slice(start_time, end_time)
+        t = store.t[t_slice]
+        lat = store.lat[lat_slice]
+        attrs = dict(store.attrs)
+        names = dict(store.names)
+        units = dict(store.units)
+
+    def blocks():
+        for start in range(t_slice.start, t_slice.stop, BBOX_BLOCK_SIZE):
+            stop = min(start + BBOX_BLOCK_SIZE, t_slice.stop)
+            block = {}
+            with store.lock:
+                for key, ds in store.datasets.items():
+                    var = ds.variables[VARIABLES[key]]
+                    values = [
+                        np.ma.filled(np.ma.asarray(var[start:stop, lat_slice, lon_slice], dtype='f4'), np.nan)
+                        for lon_slice in lon_slices
+                    ]
+                    block[key] = np.concatenate(values, axis=-1)
+            yield slice(start - t_slice.start, stop - t_slice.start), block
+
+    cube = {
+        "time": t,
+        "lat": lat,
+        "lon": lon,
+        "variables": list(VARIABLES.keys()),
+        "names": names,
+        "units": units,
+        "attrs": attrs,
+        "blocks": blocks()
+    }
+    return cube
@@ -0,0 +1,168 @@
+import contextlib
+import json
+import logging
+import pathlib
+import sqlite3
+import time
+
+import pandas as pd
+
+from . import intervals
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS measurements (
+    station TEXT NOT NULL,
+    quantity TEXT NOT NULL,
+    time INTEGER NOT NULL,
+    value REAL,
+    status TEXT,
+    quality TEXT,
+    PRIMARY KEY (station, quantity, time)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS coverage (
+    station TEXT NOT NULL,
+    quantity TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    end INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS coverage_key ON coverage (station, quantity);
+CREATE TABLE IF NOT EXISTS series (
+    station TEXT NOT NULL,
+    quantity TEXT NOT NULL,
+    info TEXT NOT NULL,
+    PRIMARY KEY (station, quantity)
+);
+"""
+
+
+# columns added after the first version of the schema
+EXTRA_COLUMNS = [
+    ('measurements', 'status', 'TEXT'),
+    ('measurements', 'quality', 'TEXT')
+]
+
+EPOCH = pd.Timestamp('1970-01-01', tz='UTC')
+
+
+def to_seconds(dt):
+    """return a datetime as seconds since the epoch, naive datetimes are in UTC"""
+    return int(intervals.utc(dt).timestamp())
+
+
+class SeriesStore(object):
+    """Local, append-only store of measurements per (station, quantity).
+
+    The store keeps the measurements in sqlite and records which periods
+    were fetched. Only the periods that are not covered yet are fetched
+    from the service. The last `lag` seconds are never marked as covered,
+    measurements can still arrive for them, so they are fetched again.
+    The database is opened in WAL mode, so it should be on a local
+    filesystem.
+    """
+
+    def __init__(self, path, lag=3600):
+        self.path = str(path)
+        self.lag = lag
+        pathlib.Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        with self.connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+            for table, column, type_ in EXTRA_COLUMNS:
+                columns = [row[1] for row in conn.execute('PRAGMA table_info(%s)' % (table, ))]
+                if column not in columns:
+                    conn.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table, column, type_))
+
+    @contextlib.contextmanager
+    def connect(self):
+        """yield a connection, commit when done, one connection per call for thread safety"""
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def coverage(self, key):
+        """return the merged intervals (in seconds) that were fetched for key"""
+        with self.connect() as conn:
+            rows = conn.execute(
+                'SELECT start, end FROM coverage WHERE station = ? AND quantity = ?',
+                key
+            ).fetchall()
+        return intervals.merge(rows)
+
+    def missing(self, key, start_time, end_time):
+        """return the intervals (in seconds) that are not in the store"""
+        return intervals.subtract(self.coverage(key), to_seconds(start_time), to_seconds(end_time))
+
+    def insert(self, key, start, end, series=None):
+        """add a fetched series and mark (start, end) (in seconds) as covered"""
+        end = min(end, int(time.time()) - self.lag)
+        with self.connect() as conn:
+            # periods of a series can be inserted concurrently, take the write lock before reading the coverage
+            conn.execute('BEGIN IMMEDIATE')
+            if series is not None:
+                data = series['data']
+                times = ((data['dateTime'] - EPOCH) // pd.Timedelta(seconds=1)).tolist() if len(data) else []
+                status = data['status'].tolist() if 'status' in data else [None] * len(data)
+                quality = data['quality'].tolist() if 'quality' in data else [None] * len(data)
+                conn.executemany(
+                    'INSERT OR REPLACE INTO measurements (station, quantity, time, value, status, quality) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    [key + row for row in zip(times, data['value'].tolist(), status, quality)]
+                )
+                info = {
+                    name: value
+                    for name, value in series.items()
+                    if name != 'data'
+                }
+                conn.execute(
+                    'INSERT OR REPLACE INTO series (station, quantity, info) VALUES (?, ?, ?)',
+                    key + (json.dumps(info), )
+                )
+            if start < end:
+                rows = conn.execute(
+                    'SELECT start, end FROM coverage WHERE station = ? AND quantity = ?',
+                    key
+                ).fetchall()
+                conn.execute('DELETE FROM coverage WHERE station = ? AND quantity = ?', key)
+                conn.executemany(
+                    'INSERT INTO coverage (station, quantity, start, end) VALUES (?, ?, ?, ?)',
+                    [key + interval for interval in intervals.merge(rows + [(start, end)])]
+                )
+
+    def read(self, key, start_time, end_time):
+        """return the stored series between start_time and end_time, None if unknown"""
+        with self.connect() as conn:
+            row = conn.execute(
+                'SELECT info FROM series WHERE station = ? AND quantity = ?',
+                key
+            ).fetchone()
+            if row is None:
+                return None
+            data = pd.read_sql_query(
+                'SELECT value, time, status, quality FROM measurements '
+                'WHERE station = ? AND quantity = ? AND time >= ? AND time <= ? ORDER BY time',
+                conn,
+                params=key + (to_seconds(start_time), to_seconds(end_time))
+            )
+        data.insert(1, 'dateTime', pd.to_datetime(data.pop('time'), unit='s', utc=True))
+        series = json.loads(row[0])
+        series['data'] = data
+        return series
+
+    def get(self, key, start_time, end_time, fetch):
+        """return the series between start_time and end_time, fetch(start, end) the missing parts
+
+        fetch is called with datetimes and returns a series or None if
+        there is no data.
+        """
+        for start, end in self.missing(key, start_time, end_time):
+            series = fetch(
+                pd.Timestamp(start, unit='s', tz='UTC').to_pydatetime(),
+                pd.Timestamp(end, unit='s', tz='UTC').to_pydatetime()
+            )
+            self.insert(key, start, end, series)
+        return self.read(key, start_time, end_time)
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+
+"""Encoders that turn measurements into response bytes in one pass.
+
+Data frames are encoded column wise by pandas and spliced into the JSON
+of the surrounding structure, so responses are serialized only once.
+
+A cube is a dict with the coordinates (time, lat, lon), the names, units
+and attributes of the variables and an iterator over blocks. Every block
+is a tuple of a time slice and a dict with a (time, lat, lon) array per
+variable, so the cube can be streamed without reading it in memory.
+"""
+import collections
+import json
+import logging
+import os
+import re
+import struct
+import tempfile
+import uuid
+
+import flask
+import netCDF4
+import numpy as np
+import pandas as pd
+
+from .utils import CustomEncoder, RawJSON
+
+logger = logging.getLogger(__name__)
+
+# time units used in binary responses
+EPOCH = np.datetime64('1970-01-01T00:00', 'm')
+TIME_UNITS = 'minutes since 1970-01-01 00:00:00'
+# stream files in blocks of 1MB
+BLOCK_SIZE = 1 << 20
+# columns of the stacked station series, see series_table
+SERIES_COLUMNS = ['value', 'dateTime', 'status', 'quality', 'name', 'units']
+
+
+def format_datetimes(column):
+    """format a datetime column as ISO 8601 strings in bulk, missing times are None"""
+    tz = column.dt.tz
+    if tz is not None:
+        column = column.dt.tz_convert('UTC').dt.tz_localize(None)
+    values = np.asarray(column.values, dtype='datetime64[s]')
+    strings = np.datetime_as_string(values, unit='s')
+    if tz is not None:
+        strings = np.char.add(strings, '+00:00')
+    strings = strings.astype(object)
+    strings[np.isnat(values)] = None
+    return pd.Series(strings, index=column.index)
+
+
+def frame_json(df, orient='records'):
+    """encode a data frame as a JSON list of records or as a JSON object of columns"""
+    columns = collections.OrderedDict()
+    for name, column in df.items():
+        if pd.api.types.is_datetime64_any_dtype(column):
+            column = format_datetimes(column)
+        columns[name] = column
+    if orient == 'columns':
+        return '{' + ', '.join(
+            json.dumps(str(name)) + ': ' + column.to_json(orient='values', double_precision=15)
+            for name, column in columns.items()
+        ) + '}'
+    df = pd.DataFrame(columns, index=df.index)
+    return df.to_json(orient='records', double_precision=15)
+
+
+class FrameEncoder(CustomEncoder):
+    """Encoder that leaves a placeholder for every data frame
+
+    The frames are encoded separately with frame_json, see dumps. Raw
+    JSON fragments are inserted in the same way.
+    """
+
+    def __init__(self, *args, orient='records', **kwargs):
+        super(FrameEncoder, self).__init__(*args, **kwargs)
+        self.orient = orient
+        self.token = uuid.uuid4().hex
+        self.frames = []
+
+    def default(self, obj):
+        if isinstance(obj, pd.DataFrame):
+            self.frames.append(frame_json(obj, orient=self.orient))
+            return '%s-%d' % (self.token, len(self.frames) - 1)
+        if isinstance(obj, RawJSON):
+            self.frames.append(obj.encoded_json)
+            return '%s-%d' % (self.token, len(self.frames) - 1)
+        return super(FrameEncoder, self).default(obj)
+
+
+def dumps(obj, orient='records'):
+    """encode obj, that may contain data frames, as JSON bytes"""
+    encoder = FrameEncoder(orient=orient)
+    text = encoder.encode(obj)
+    if encoder.frames:
+        text = re.sub(
+            '"%s-([0-9]+)"' % (encoder.token, ),
+            lambda match: encoder.frames[int(match.group(1))],
+            text
+        )
+    return text.encode('utf-8')
+
+
+def json_response(obj):
+    """return obj as a JSON response, serialized once"""
+    return flask.Response(dumps(obj), mimetype='application/json')
+
+
+def cube_header(cube):
+    """return the JSON header of a float32 cube"""
+    shape = [len(cube['time']), len(cube['variables']), len(cube['lat']), len(cube['lon'])]
+    header = {
+        "dtype": "<f4",
+        "shape": shape,
+        "dimensions": ["time", "variable", "lat", "lon"],
+        "variables": cube['variables'],
+        "names": cube['names'],
+        "units": cube['units'],
+        "time": np.datetime_as_string(cube['time'], unit='m').tolist(),
+        "lat": np.asarray(cube['lat'], dtype='f8').tolist(),
+        "lon": np.asarray(cube['lon'], dtype='f8').tolist(),
+        "attrs": cube['attrs']
+    }
+    return header
+
+
+def float32_stream(cube):
+    """stream a cube as raw little-endian float32 with a JSON header
+
+    The stream starts with the length of the header as a little-endian
+    uint32, followed by the UTF-8 encoded header and the values in
+    (time, variable, lat, lon) order.
+    """
+    header = json.dumps(cube_header(cube), cls=CustomEncoder).encode('utf-8')
+    yield struct.pack('<I', len(header))
+    yield header
+    for _, block in cube['blocks']:
+        values = np.stack([block[name] for name in cube['variables']], axis=1)
+        yield np.ascontiguousarray(values, dtype='<f4').tobytes()
+
+
+def netcdf_stream(cube):
+    """stream a cube as a netCDF file"""
+    fd, path = tempfile.mkstemp(suffix='.nc')
+    os.close(fd)
+    try:
+        with netCDF4.Dataset(path, 'w') as ds:
+            ds.setncatts(cube['attrs'])
+            ds.createDimension('time', len(cube['time']))
+            ds.createDimension('lat', len(cube['lat']))
+            ds.createDimension('lon', len(cube['lon']))
+            var = ds.createVariable('time', 'f8', ('time', ))
+            var.units = TIME_UNITS
+            var[:] = (cube['time'] - EPOCH).astype('timedelta64[m]').astype('f8')
+            var = ds.createVariable('lat', 'f4', ('lat', ))
+            var.units = 'degrees_north'
+            var[:] = cube['lat']
+            var = ds.createVariable('lon', 'f4', ('lon', ))
+            var.units = 'degrees_east'
+            var[:] = cube['lon']
+            for name in cube['variables']:
+                var = ds.createVariable(name, 'f4', ('time', 'lat', 'lon'), zlib=True, fill_value=np.nan)
+                var.long_name = cube['names'][name]
+                var.units = cube['units'][name]
+            for t_slice, block in cube['blocks']:
+                for name in cube['variables']:
+                    ds.variables[name][t_slice] = block[name]
+        with open(path, 'rb') as f:
+            for data in iter(lambda: f.read(BLOCK_SIZE), b''):
+                yield data
+    finally:
+        os.remove(path)
+
+
+def series_table(data):
+    """return all series of a measurements response as one data frame
+
+    Station measurements contain a list of series, they are stacked with
+    the name and units of the series as extra columns.
+    """
+    series = data['series']
+    if isinstance(series, pd.DataFrame):
+        return series
+    frames = []
+    for item in series:
+        frame = item['data'].copy()
+        frame['name'] = item['name']
+        frame['units'] = item['units']
+        frames.append(frame)
+    if not frames:
+        return pd.DataFrame(columns=SERIES_COLUMNS)
+    table = pd.concat(frames, ignore_index=True)
+    # the same columns with or without data
+    columns = SERIES_COLUMNS + [name for name in table.columns if name not in SERIES_COLUMNS]
+    return table.reindex(columns=columns)
+
+
+def series_records(data):
+    return dumps(data)
+
+
+def series_columns(data):
+    return dumps(data, orient='columns')
+
+
+def series_csv(data):
+    table = series_table(data).copy()
+    for name, column in table.items():
+        if pd.api.types.is_datetime64_any_dtype(column):
+            table[name] = format_datetimes(column)
+    return table.to_csv(index=False).encode('utf-8')
+
+
+def series_arrow(data):
+    """encode the series as an Arrow IPC stream, requires pyarrow"""
+    import pyarrow
+    table = pyarrow.Table.from_pandas(series_table(data), preserve_index=False)
+    sink = pyarrow.BufferOutputStream()
+    writer = pyarrow.RecordBatchStreamWriter(sink, table.schema)
+    writer.write_table(table)
+    writer.close()
+    return sink.getvalue().to_pybytes()
+
+
+def series_netcdf(data):
+    """encode the series as a netCDF file with one variable per column"""
+    table = series_table(data)
+    fd, path = tempfile.mkstemp(suffix='.nc')
+    os.close(fd)
+    try:
+        with netCDF4.Dataset(path, 'w') as ds:
+            ds.createDimension('index', len(table))
+            for name, column in table.items():
+                if pd.api.types.is_datetime64_any_dtype(column):
+                    if column.dt.tz is not None:
+                        column = column.dt.tz_convert('UTC').dt.tz_localize(None)
+                    var = ds.createVariable(name, 'f8', ('index', ))
+                    var.units = TIME_UNITS
+                    var[:] = (column.values - EPOCH).astype('timedelta64[m]').astype('f8')
+                elif pd.api.types.is_numeric_dtype(column):
+                    var = ds.createVariable(name, 'f8', ('index', ), fill_value=np.nan)
+                    var[:] = column.values.astype('f8')
+                else:
+                    var = ds.createVariable(name, str, ('index', ))
+                    # missing status or quality of stored rows
+                    var[:] = column.fillna('').astype(str).values.astype(object)
+        with open(path, 'rb') as f:
+            return f.read()
+    finally:
+        os.remove(path)
+
+
+# available series formats with their mimetype, the first is the default
+series_formats = collections.OrderedDict([
+    ("json", (series_records, 'application/json')),
+    ("columns", (series_columns, 'application/vnd.stathakis.columns+json')),
+    ("csv", (series_csv, 'text/csv')),
+    ("arrow", (series_arrow, 'application/vnd.apache.arrow.stream')),
+    ("netcdf", (series_netcdf, 'application/x-netcdf'))
+])
+
+
+def best_series_format(accept_mimetypes):
+    """return the series format that matches the accepted mimetypes best, json by default"""
+    mimetypes = [mimetype for _, mimetype in series_formats.values()]
+    best = accept_mimetypes.best_match(mimetypes, default='application/json')
+    return [key for key, (_, mimetype) in series_formats.items() if mimetype == best][0]
+
+
+def series_response(data, format=None):
+    """return measurements in the requested format
+
+    The format is taken from the format parameter or, if it is not
+    given, from the Accept header of the request.
+    """
+    if format is None:
+        format = best_series_format(flask.request.accept_mimetypes)
+    if format not in series_formats:
+        flask.abort(406, "unknown format %s" % (format, ))
+    encode, mimetype = series_formats[format]
+    try:
+        body = encode(data)
+    except ImportError:
+        logger.exception("format %s is not available", format)
+        flask.abort(406, "format %s is not available" % (format, ))
+    return flask.Response(body, mimetype=mimetype)
+
+
+# available binary formats with their mimetype
+binary_formats = {
+    "netcdf": (netcdf_stream, 'application/x-netcdf'),
+    "float32": (float32_stream, 'application/octet-stream')
+}
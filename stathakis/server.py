@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+"""Production server, the app is served by a pool of gunicorn worker processes."""
+import logging
+
+import gunicorn.app.base
+
+from .app import make_app
+from .measurements import after_fork
+
+logger = logging.getLogger(__name__)
+
+
+def post_fork(server, worker):
+    """reopen the shared state of a preloaded app in the new worker"""
+    config = server.app.config
+    if config is None:
+        # not preloaded, the worker loads the app itself
+        return
+    logger.info("worker %s: reopening grids and connections", worker.pid)
+    after_fork(config)
+
+
+class Server(gunicorn.app.base.BaseApplication):
+    """Serve stathakis with gunicorn.
+
+    With preload the app is created once in the master process, so the
+    grid axes and the catalogue snapshot (DDL_SNAPSHOT_DIR), if there is
+    one, are loaded before the workers are forked. Without a snapshot each
+    worker loads the catalogue itself. The master starts no threads, each
+    worker reopens the files and connections and starts the catalogue
+    refresher and the fetch executor after the fork. Send
+    HUP to the master for a graceful reload of the workers, workers that
+    don't answer within timeout seconds are restarted.
+    """
+
+    def __init__(self, options=None, use_asyncio=False, threads=4):
+        self.options = options or {}
+        self.use_asyncio = use_asyncio
+        self.threads = threads
+        self.application = None
+        self.config = None
+        super(Server, self).__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            if key in self.cfg.settings and value is not None:
+                self.cfg.set(key, value)
+        self.cfg.set('post_fork', post_fork)
+
+    def load(self):
+        if self.application is None:
+            # a preloaded app is made in the master, threads don't survive the fork
+            app = make_app(start_threads=not self.cfg.preload_app)
+            self.config = app.app.config
+            if self.use_asyncio:
+                # only needed for the asyncio workers
+                from .aio import make_aio_app
+                self.application = make_aio_app(app, threads=self.threads)
+            else:
+                # the connexion app wraps the flask (wsgi) app
+                self.application = app.app
+        return self.application
+
+
+def serve(
+        host='127.0.0.1',
+        port=8080,
+        workers=4,
+        threads=1,
+        timeout=120,
+        graceful_timeout=30,
+        preload=True,
+        use_asyncio=False
+):
+    """run the app in worker processes until the master is stopped
+
+    With use_asyncio the workers run an event loop, see stathakis.aio,
+    the threads serve the other endpoints.
+    """
+    options = {
+        'bind': '%s:%d' % (host, port),
+        'workers': workers,
+        'threads': threads,
+        'timeout': timeout,
+        'graceful_timeout': graceful_timeout,
+        'preload_app': preload
+    }
+    if use_asyncio:
+        options['worker_class'] = 'aiohttp.GunicornWebWorker'
+    Server(options, use_asyncio=use_asyncio, threads=threads).run()
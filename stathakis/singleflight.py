@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+"""Coalesce identical concurrent fetches (single-flight)."""
+import asyncio
+import concurrent.futures
+import functools
+import hashlib
+import logging
+import os
+import pathlib
+import struct
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # no process locks on this platform
+    fcntl = None
+
+from .cache import dumps, loads
+
+logger = logging.getLogger(__name__)
+
+# seconds between attempts to get a file lock in the event loop
+LOCK_POLL_MIN = 0.01
+LOCK_POLL_MAX = 0.5
+# time a result was published, in front of the encoded result
+PUBLISHED = struct.Struct('<d')
+
+
+class SingleFlight(object):
+    """Share the result of a fetch between the concurrent callers of a key.
+
+    The first caller of a key runs the fetch, callers that arrive while it
+    runs wait for it and get the same result or exception. With a
+    `lock_dir` the fetches of a lock key are also serialized between
+    processes with file locks. The fetch should then first look in the
+    shared store that the other processes fill, it might have been fetched
+    while waiting for the lock. Results that the store doesn't keep, such
+    as recent data, can be published next to the lock file instead: a
+    process that waited for the lock uses the result that was published
+    while it waited.
+    """
+
+    def __init__(self, lock_dir=None):
+        if lock_dir and fcntl is None:
+            logger.warning("file locks are not available, fetches are only coalesced within a process")
+            lock_dir = None
+        self.lock_dir = pathlib.Path(lock_dir) if lock_dir else None
+        self.lock = threading.Lock()
+        # in flight fetches of threads (concurrent futures) and of the event loop (asyncio tasks)
+        self.calls = {}
+        self.tasks = {}
+
+    def path(self, lock_key, suffix):
+        """return the path of a file of lock_key, in subdirectories of lock_dir"""
+        digest = hashlib.sha1(repr(lock_key).encode('utf-8')).hexdigest()
+        directory = self.lock_dir / digest[:2]
+        directory.mkdir(parents=True, exist_ok=True)
+        return directory / (digest + suffix)
+
+    def lock_file(self, lock_key):
+        """open the lock file of lock_key, one file per key"""
+        return self.path(lock_key, '.lock').open('a')
+
+    def read_result(self, lock_key, since):
+        """return the result of lock_key that was published after since (seconds), KeyError if there is none"""
+        try:
+            data = self.path(lock_key, '.result').read_bytes()
+            (published, ) = PUBLISHED.unpack_from(data)
+            if published >= since:
+                return loads(data[PUBLISHED.size:])
+        except FileNotFoundError:
+            pass
+        except (ImportError, ValueError, struct.error):
+            logger.warning("could not read the published result of %s", lock_key, exc_info=True)
+        raise KeyError(lock_key)
+
+    def write_result(self, lock_key, result):
+        """publish the result of lock_key for the processes that wait for the lock"""
+        try:
+            data = PUBLISHED.pack(time.time()) + dumps(result)
+        except (ImportError, TypeError):
+            logger.warning("could not publish the result of %s", lock_key, exc_info=True)
+            return
+        path = self.path(lock_key, '.result')
+        tmp_path = path.with_suffix('.%d.tmp' % (os.getpid(), ))
+        tmp_path.write_bytes(data)
+        os.replace(str(tmp_path), str(path))
+
+    def acquire(self, lock_key):
+        """wait for the file lock of lock_key, return the locked file or None without lock_dir"""
+        if self.lock_dir is None or lock_key is None:
+            return None
+        f = self.lock_file(lock_key)
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        except BaseException:
+            f.close()
+            raise
+        return f
+
+    async def acquire_async(self, lock_key):
+        """wait for the file lock of lock_key without blocking a thread, like acquire"""
+        if self.lock_dir is None or lock_key is None:
+            return None
+        f = self.lock_file(lock_key)
+        delay = LOCK_POLL_MIN
+        try:
+            while True:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return f
+                except BlockingIOError:
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, LOCK_POLL_MAX)
+        except BaseException:
+            f.close()
+            raise
+
+    def release(self, f):
+        if f is None:
+            return
+        try:
+            fcntl.flock(f, fcntl.LOCK_UN)
+        finally:
+            f.close()
+
+    def do(self, key, fetch, lock_key=None, publish=False):
+        """return fetch(), shared with the concurrent calls of key
+
+        lock_key is the key of the process lock, None for no process lock.
+        With publish the result is shared with the processes that wait for
+        the lock, it is encoded with stathakis.cache.dumps.
+        """
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = concurrent.futures.Future()
+                self.calls[key] = future
+        if not leader:
+            return future.result()
+        try:
+            result = self.run(fetch, lock_key, publish)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+    def run(self, fetch, lock_key, publish):
+        """return fetch() in the process lock of lock_key, or the result another process published"""
+        since = time.time()
+        lock = self.acquire(lock_key)
+        try:
+            if lock is None or not publish:
+                return fetch()
+            try:
+                return self.read_result(lock_key, since)
+            except KeyError:
+                result = fetch()
+                self.write_result(lock_key, result)
+                return result
+        finally:
+            self.release(lock)
+
+    async def do_async(self, key, fetch, lock_key=None, publish=False):
+        """return await fetch(), shared with the concurrent awaits of key in the event loop
+
+        The fetch runs in its own task, a cancelled caller (a client that
+        disconnected) does not cancel it for the other callers. The files
+        of publish are read and written in the default executor of the
+        loop.
+        """
+        task = self.tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self.run_async(fetch, lock_key, publish))
+            self.tasks[key] = task
+            task.add_done_callback(functools.partial(self.done_async, key))
+        return await asyncio.shield(task)
+
+    async def run_async(self, fetch, lock_key, publish):
+        since = time.time()
+        lock = await self.acquire_async(lock_key)
+        try:
+            if lock is None or not publish:
+                return await fetch()
+            loop = asyncio.get_event_loop()
+            try:
+                return await loop.run_in_executor(None, self.read_result, lock_key, since)
+            except KeyError:
+                result = await fetch()
+                await loop.run_in_executor(None, self.write_result, lock_key, result)
+                return result
+        finally:
+            self.release(lock)
+
+    def done_async(self, key, task):
+        if self.tasks.get(key) is task:
+            del self.tasks[key]
+        if not task.cancelled():
+            # mark the exception as retrieved, all callers might be gone
+            task.exception()
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+"""Shared HTTP client for the upstream services."""
+import contextlib
+import logging
+import threading
+
+import requests
+import requests.adapters
+from requests.packages.urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+# retry on server errors, the requests only read data, so POST is safe to retry
+STATUS_FORCELIST = (500, 502, 503, 504)
+RETRY_METHODS = frozenset(['GET', 'POST'])
+
+
+def make_retry(retries, backoff_factor):
+    """return a retry policy with exponential backoff"""
+    kwargs = dict(
+        total=retries,
+        connect=retries,
+        read=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=STATUS_FORCELIST
+    )
+    try:
+        return Retry(allowed_methods=RETRY_METHODS, **kwargs)
+    except TypeError:
+        # urllib3 < 1.26
+        return Retry(method_whitelist=RETRY_METHODS, **kwargs)
+
+
+# client arguments and their setting names, without prefix
+SETTINGS = {
+    'pool_size': 'POOL_SIZE',
+    'max_concurrent': 'MAX_CONCURRENT',
+    'connect_timeout': 'CONNECT_TIMEOUT',
+    'read_timeout': 'READ_TIMEOUT',
+    'retries': 'RETRIES',
+    'backoff_factor': 'BACKOFF_FACTOR'
+}
+
+
+def client_settings(config, prefix):
+    """return the client arguments from the settings that start with prefix"""
+    return {
+        arg: config[prefix + key]
+        for arg, key in SETTINGS.items()
+        if prefix + key in config
+    }
+
+
+class UpstreamClient(object):
+    """Pooled HTTP session for an upstream service.
+
+    Connections are kept alive and reused, at most `max_concurrent` requests
+    are sent at the same time. Connection errors, timeouts and server errors
+    are retried with exponential backoff and responses are compressed.
+    """
+
+    def __init__(
+            self,
+            pool_size=10,
+            max_concurrent=4,
+            connect_timeout=10,
+            read_timeout=60,
+            retries=3,
+            backoff_factor=0.5
+    ):
+        self.max_concurrent = max_concurrent
+        self.timeout = (connect_timeout, read_timeout)
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=make_retry(retries, backoff_factor)
+        )
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers['Accept-Encoding'] = 'gzip, deflate'
+
+    @classmethod
+    def from_config(cls, config, prefix):
+        """create a client from the settings that start with prefix (DDL_POOL_SIZE, ...)"""
+        return cls(**client_settings(config, prefix))
+
+    def post(self, url, **kwargs):
+        """post a request, using a pooled connection, use stream to read the body while it arrives"""
+        kwargs.setdefault('timeout', self.timeout)
+        with self.slots:
+            return self.session.post(url, **kwargs)
+
+    @contextlib.contextmanager
+    def stream(self, url, **kwargs):
+        """post a request and yield the streamed response, which counts as a request until it is closed"""
+        kwargs.setdefault('timeout', self.timeout)
+        with self.slots:
+            resp = self.session.post(url, stream=True, **kwargs)
+            try:
+                yield resp
+            finally:
+                resp.close()
@@ -4,10 +4,10 @@ import simplejson
 
 
 def df2geojson(df):
-    """convert a dataframe to a geojson object"""
+    """convert a dataframe with lon and lat columns to a geojson object"""
     def row2feature(row):
         properties = row.to_dict()
-        geometry = row.point
+        geometry = geojson.Point((row.lon, row.lat))
         feature = geojson.Feature(id=row.name, geometry=geometry, properties=properties)
         return feature
     features = df.apply(row2feature, axis=1).values
@@ -15,6 +15,13 @@ def df2geojson(df):
     return fc
 
 
+class RawJSON(object):
+    """A pre-encoded JSON fragment, inserted as is by stathakis.responses.dumps"""
+
+    def __init__(self, encoded_json):
+        self.encoded_json = encoded_json
+
+
 class CustomEncoder(simplejson.JSONEncoder):
     """Support for data types that JSON default encoder
     does not do.
@@ -0,0 +1,133 @@
+import fnmatch
+import socketserver
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from stathakis.cache import LmdbNamespaceManager, RedisNamespaceManager, dumps, loads, region_settings
+
+
+def make_value():
+    data = pd.DataFrame({
+        'value': [1.0, np.nan, 3.5],
+        'dateTime': pd.date_range('2017-01-01', periods=3, freq='10min', tz='UTC'),
+        'status': ['Gecontroleerd', None, 'Ongecontroleerd']
+    })
+    series = {
+        'name': 'sea surface height',
+        'units': 'cm',
+        'metadata': {'X': np.int64(1), 'Y': 2.5},
+        'data': data
+    }
+    return [time.time(), 60, {'series': [series], 'time': pd.Timestamp('2017-01-01', tz='UTC')}]
+
+
+def test_dumps():
+    pytest.importorskip('pyarrow')
+    value = make_value()
+    stored, expire, result = loads(dumps(value))
+    assert stored == value[0] and expire == 60
+    series = result['series'][0]
+    assert series['metadata'] == {'X': 1, 'Y': 2.5}
+    assert result['time'] == value[2]['time']
+    pd.testing.assert_frame_equal(series['data'], value[2]['series'][0]['data'], check_dtype=False)
+
+
+def test_lmdb(tmpdir):
+    pytest.importorskip('lmdb')
+    pytest.importorskip('pyarrow')
+    namespace = LmdbNamespaceManager('test', data_dir=str(tmpdir))
+    other = LmdbNamespaceManager('other', data_dir=str(tmpdir))
+    namespace.set_value('a', make_value(), expiretime=60)
+    namespace.set_value('b', [1, None, 'b'], expiretime=0.01)
+    other['a'] = 'other'
+    time.sleep(0.02)
+    assert 'a' in namespace
+    assert 'b' not in namespace
+    assert sorted(namespace.keys()) == ['a', 'b']
+    assert namespace['a'][2]['series'][0]['units'] == 'cm'
+    namespace.purge()
+    assert namespace.keys() == ['a']
+    namespace.do_remove()
+    assert 'a' not in namespace
+    assert other['a'] == 'other'
+
+
+class RespHandler(socketserver.StreamRequestHandler):
+    """the redis commands that are used by the cache, without expiry"""
+    data = {}
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        assert line.startswith(b'*')
+        args = []
+        for i in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def bulk(self, value):
+        if value is None:
+            return b'$-1\r\n'
+        return b'$%d\r\n%s\r\n' % (len(value), value)
+
+    def handle(self):
+        while True:
+            args = self.read_command()
+            if args is None:
+                return
+            command = args[0].upper()
+            if command == b'GET':
+                reply = self.bulk(self.data.get(args[1]))
+            elif command in (b'SET', b'SETEX'):
+                self.data[args[1]] = args[-1]
+                reply = b'+OK\r\n'
+            elif command == b'EXISTS':
+                reply = b':%d\r\n' % (args[1] in self.data, )
+            elif command == b'DEL':
+                reply = b':%d\r\n' % (self.data.pop(args[1], None) is not None, )
+            elif command == b'SCAN':
+                pattern = args[args.index(b'MATCH') + 1].decode('utf-8')
+                keys = [key for key in self.data if fnmatch.fnmatchcase(key.decode('utf-8'), pattern)]
+                reply = b'*2\r\n' + self.bulk(b'0') + b'*%d\r\n' % (len(keys), ) + b''.join(self.bulk(key) for key in keys)
+            else:
+                reply = b'+OK\r\n'
+            self.wfile.write(reply)
+
+
+@pytest.fixture
+def redis_url():
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), RespHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield 'redis://127.0.0.1:%d/0' % (server.server_address[1], )
+    server.shutdown()
+    server.server_close()
+
+
+def test_redis(redis_url):
+    pytest.importorskip('redis')
+    pytest.importorskip('pyarrow')
+    namespace = RedisNamespaceManager('test', url=redis_url)
+    namespace.set_value('a b', make_value(), expiretime=60)
+    assert 'a b' in namespace
+    assert 'c' not in namespace
+    assert namespace.keys() == ['a b']
+    assert namespace['a b'][2]['series'][0]['data']['value'].iloc[-1] == 3.5
+    namespace.do_remove()
+    assert namespace.keys() == []
+
+
+def test_region_settings():
+    assert region_settings({}) == {'type': 'memory', 'expire': 60}
+    pytest.importorskip('lmdb')
+    pytest.importorskip('pyarrow')
+    config = {'CACHE_TYPE': 'stathakis.lmdb', 'CACHE_DIR': '/tmp/cache', 'CACHE_URL': 'redis://'}
+    assert region_settings(config) == {'type': 'stathakis.lmdb', 'expire': 60, 'data_dir': '/tmp/cache'}
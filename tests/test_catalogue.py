@@ -0,0 +1,100 @@
+import threading
+import time
+
+import pandas as pd
+import pytest
+
+from stathakis.measurements.catalogue import CatalogueRefresher, StationIndex, load_snapshot, save_snapshot
+from stathakis.responses import dumps
+
+
+def test_refresher_single_flight():
+    loads = []
+
+    def load():
+        loads.append(time.time())
+        time.sleep(0.1)
+        return len(loads)
+
+    refresher = CatalogueRefresher(load, interval=60)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(refresher.get())) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [1] * 5, "all requests should share one load"
+
+
+def test_refresher_stale():
+    refresher = CatalogueRefresher(lambda: time.time(), interval=0.05)
+    first = refresher.get()
+    time.sleep(0.1)
+    # the stale catalogue is served while a new one is loaded
+    assert refresher.get() == first
+    time.sleep(0.1)
+    assert refresher.get() != first
+
+
+def test_station_index():
+    # two rows (quantities) per station, along the equator
+    lon = [float(x) for x in range(-179, 180, 2) for _ in range(2)]
+    df = pd.DataFrame({
+        'code': ['S%d' % (x, ) for x in lon],
+        'quantity': ['WATHTE', 'T'] * (len(lon) // 2),
+        'lon': lon,
+        'lat': [0.0] * len(lon)
+    })
+    index = StationIndex(df, {'waterlevel': ['WATHTE'], 'all': ['WATHTE', 'T']})
+    positions = index.nearest((2.5, 0), 3, quantity='all')
+    assert list(df.code.values[positions]) == ['S3', 'S3', 'S1', 'S1', 'S5', 'S5']
+    positions = index.nearest((0, 0), 1000, quantity='waterlevel')
+    assert len(positions) == len(df) // 2, "all stations of the group"
+    # a box that crosses the antimeridian
+    positions = index.within((175, -1, -175, 1))
+    assert sorted(set(df.code.values[positions])) == ['S-175', 'S-177', 'S-179', 'S175', 'S177', 'S179']
+
+
+def test_snapshot(tmpdir):
+    pytest.importorskip('pyarrow')
+    df = pd.DataFrame({
+        'code': ['A', 'B', 'C'],
+        'quantity': ['WATHTE', 'WATHTE', 'T'],
+        'lon': [4.1, 4.5, 5.2],
+        'lat': [52.1, 52.3, 53.0],
+        'Grootheid': [{'Code': 'WATHTE'}, {'Code': 'WATHTE'}, {'Code': 'T'}]
+    }, index=[3, 5, 7])
+    index = StationIndex(df, {'waterlevel': ['WATHTE']}, properties={'dataset': 'test'}, modified=900.0)
+    save_snapshot(str(tmpdir), index, 1000.0)
+    loaded_index, loaded = load_snapshot(str(tmpdir))
+    assert loaded == 1000.0
+    # the same version in every process that loads the catalogue
+    assert loaded_index.version == index.version
+    assert loaded_index.modified == 900.0
+    pd.testing.assert_frame_equal(loaded_index.df, df)
+    assert dumps(loaded_index.feature_collection()) == dumps(index.feature_collection())
+    assert dumps(loaded_index.feature_collection(quantity='waterlevel')) == dumps(index.feature_collection(quantity='waterlevel'))
+
+
+def test_refresher_outage():
+    loads = []
+
+    def load():
+        loads.append(time.time())
+        if len(loads) > 1:
+            time.sleep(0.05)
+            raise IOError("catalogue service is down")
+        return len(loads)
+
+    refresher = CatalogueRefresher(load, interval=10)
+    refresher.get()
+    # stale, all requests share one refresh
+    refresher.current = (1, time.time() - 20)
+    for i in range(20):
+        assert refresher.get() == 1
+    time.sleep(0.1)
+    assert len(loads) == 2
+    # the failed refresh is not retried at once
+    for i in range(20):
+        assert refresher.get() == 1
+    assert len(loads) == 2
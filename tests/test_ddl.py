@@ -1,6 +1,21 @@
+import asyncio
+import datetime
+import io
+import json
+import os
+import time
+
+import pandas as pd
+import pytest
+import beaker.cache
 import dateutil.parser
 
+from stathakis.cache import LmdbNamespaceManager
 from stathakis.measurements import ddl
+from stathakis.measurements.catalogue import CatalogueRefresher
+from stathakis.measurements.intervals import IntervalCache
+from stathakis.measurements.store import SeriesStore
+from stathakis.singleflight import SingleFlight
 
 
 def test_metadata():
@@ -10,6 +25,82 @@ def test_metadata():
     assert len(metadata_df) > 10, "we should have at least 10 records, got %s" % (list(metadata_df))
 
 
+def test_metadata_snapshot(monkeypatch):
+    calls = []
+
+    def fetch_metadata():
+        calls.append(1)
+        return {'Succesvol': True}
+
+    refresher = CatalogueRefresher(lambda: {"metadata": None, "index": None})
+    monkeypatch.setattr(ddl, 'catalogue_refresher', refresher)
+    monkeypatch.setattr(ddl, 'fetch_metadata', fetch_metadata)
+    assert ddl.get_metadata()['Succesvol']
+    assert ddl.get_metadata()['Succesvol']
+    assert len(calls) == 1, "the metadata of a snapshot should be fetched once"
+
+
+def test_station_measurements_async_cache(tmpdir, monkeypatch):
+    pytest.importorskip('lmdb')
+    pytest.importorskip('pyarrow')
+    calls = []
+
+    async def get_data_async(aio_client, station, quantity, start_time, end_time):
+        calls.append(station)
+        data = pd.DataFrame({'value': [1.0], 'dateTime': [start_time]})
+        return {'series': [{'name': 'sea surface height', 'units': 'cm', 'data': data}]}
+
+    monkeypatch.setattr(ddl, 'get_data_async', get_data_async)
+    monkeypatch.setattr(ddl, 'measurements_cache', ddl.measurements_cache)
+    monkeypatch.setitem(beaker.cache.cache_regions, 'short_term', beaker.cache.cache_regions['short_term'])
+    ddl.configure({'CACHE_TYPE': 'stathakis.lmdb', 'CACHE_DIR': str(tmpdir), 'DDL_CATALOGUE_BACKGROUND': False})
+    start_time = dateutil.parser.parse("2017-3-10T09:00:00.000+01:00")
+    end_time = dateutil.parser.parse("2017-3-12T09:00:00.000+01:00")
+    loop = asyncio.new_event_loop()
+    try:
+        for i in range(2):
+            data = loop.run_until_complete(
+                ddl.get_station_measurements_async(None, 'HOEKVHLD', 'waterlevel', start_time, end_time)
+            )
+    finally:
+        loop.close()
+    assert len(calls) == 1, "the second request should be served from the cache"
+    assert data['series'][0]['data']['value'].tolist() == [1.0]
+    assert len(LmdbNamespaceManager('stathakis.measurements.ddl:measurements', data_dir=str(tmpdir)).keys()) == 1
+
+
+def test_fetch_series_processes(tmpdir, monkeypatch):
+    pytest.importorskip('pyarrow')
+    calls = tmpdir.join('calls')
+
+    def get_series(row, start_time, end_time, validated=False):
+        with calls.open('a') as f:
+            f.write('%s\n' % (os.getpid(), ))
+        time.sleep(0.5)
+        times = pd.date_range(start_time, end_time, freq='10min')
+        return {"name": "sea surface height", "units": "cm", "data": pd.DataFrame({"value": 1.0, "dateTime": times})}
+
+    monkeypatch.setattr(ddl, 'get_series', get_series)
+    monkeypatch.setattr(ddl, 'store', SeriesStore(str(tmpdir.join('series.sqlite'))))
+    monkeypatch.setattr(ddl, 'flights', SingleFlight(str(tmpdir.join('locks'))))
+    monkeypatch.setattr(ddl, 'series_cache', IntervalCache())
+    row = pd.Series({'code': 'HOEKVHLD', 'quantity': 'WATHTE'})
+    # the store does not cover the last hour
+    end_time = pd.Timestamp.now(tz='UTC').floor('min').to_pydatetime()
+    start_time = end_time - datetime.timedelta(hours=1)
+    pid = os.fork()
+    if pid == 0:
+        try:
+            ddl.fetch_series(row, start_time, end_time)
+        finally:
+            os._exit(0)
+    time.sleep(0.1)
+    series = ddl.fetch_series(row, start_time, end_time)
+    os.waitpid(pid, 0)
+    assert len(series['data']) == 7
+    assert len(calls.readlines()) == 1, "the process that waited should use the published series"
+
+
 def test_get_data():
     station = 'HOEKVHLD'
     start_time = dateutil.parser.parse("2017-3-10T09:00:00.000+01:00")
@@ -23,3 +114,81 @@ def test_stations():
     quantity = 'waterlevel'
     ddl_data = ddl.get_stations_per_quantity(quantity)
     assert len(ddl_data['features']) >= 10, "we should have at least 10 records"
+
+
+def test_station_index():
+    index = ddl.get_station_index()
+    assert ddl.get_station_index() is index, "index should be reused"
+    waterlevel_df = index.select(quantity='waterlevel')
+    assert set(waterlevel_df.quantity) <= set(ddl.FILTERS['waterlevel'])
+    assert len(index.select()) >= len(waterlevel_df)
+
+
+def test_station_info():
+    info = ddl.get_station_info('HOEKVHLD')
+    assert len(info['features']) >= 1, "we should find the station"
+
+
+def test_stations_near():
+    # Hoek van Holland
+    ddl_data = ddl.get_stations_per_quantity('waterlevel', near=[4.12, 51.98], k=3)
+    assert len(ddl_data['features']) >= 3, "we should find nearby stations"
+    index = ddl.get_station_index()
+    nearest = index.nearest([4.12, 51.98], 3, quantity='waterlevel')
+    assert len(set(index.df.code.values[nearest])) == 3, "we should have 3 stations"
+
+
+def test_measurements2df():
+    measurements = [
+        {
+            "Tijdstip": "2017-03-10T01:00:00.000+01:00",
+            "Meetwaarde": {"Waarde_Numeriek": 12.0},
+            "WaarnemingMetadata": {"StatuswaardeLijst": ["Gecontroleerd"], "KwaliteitswaardecodeLijst": ["00"]}
+        },
+        {
+            "Tijdstip": "2017-03-10T01:10:00.000+01:00",
+            "Meetwaarde": {"Waarde_Numeriek": 13.0},
+            "WaarnemingMetadata": {"StatuswaardeLijst": ["Ongecontroleerd"], "KwaliteitswaardecodeLijst": ["25"]}
+        }
+    ]
+    df = ddl.measurements2df(measurements)
+    assert list(df.columns) == ['value', 'dateTime', 'status', 'quality']
+    assert df['dateTime'][0] == pd.Timestamp('2017-03-10T00:00', tz='UTC')
+    assert list(df['quality']) == ['00', '25']
+    validated = ddl.measurements2df(measurements, validated=True)
+    assert list(validated['value']) == [12.0]
+
+
+def test_parse_observations():
+    pytest.importorskip('ijson')
+    measurements = [
+        {
+            "Tijdstip": "2017-03-10T01:%02d:00.000+01:00" % (i, ),
+            "Meetwaarde": {"Waarde_Numeriek": float(i)},
+            "WaarnemingMetadata": {
+                "StatuswaardeLijst": ["Gecontroleerd" if i % 2 else "Ongecontroleerd"],
+                "KwaliteitswaardecodeLijst": ["00"]
+            }
+        }
+        for i in range(60)
+    ]
+    response = {
+        "Succesvol": True,
+        "WaarnemingenLijst": [
+            {
+                "AquoMetadata": {"Grootheid": {"Code": "WATHTE"}, "Eenheid": {"Code": "cm"}},
+                "Locatie": {"Code": "HOEKVHLD", "X": 576917.669784, "Y": 5759136.15818},
+                "MetingenLijst": measurements
+            }
+        ]
+    }
+    stream = io.BytesIO(json.dumps(response).encode())
+    metadata, df = ddl.parse_observations(stream)
+    assert metadata['Eenheid']['Code'] == 'cm'
+    assert metadata['Code'] == 'HOEKVHLD'
+    # stored as JSON with the series
+    assert json.loads(json.dumps(metadata))['X'] == 576917.669784
+    pd.testing.assert_frame_equal(df, ddl.measurements2df(measurements), check_dtype=False)
+    stream = io.BytesIO(json.dumps(response).encode())
+    metadata, df = ddl.parse_observations(stream, validated=True)
+    assert len(df) == 30
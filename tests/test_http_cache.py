@@ -0,0 +1,62 @@
+import datetime
+
+import flask
+
+from stathakis import http_cache
+
+
+def test_is_modified():
+    etag = http_cache.make_etag('rws', 1500000000.5, 'ST001')
+    assert http_cache.is_modified({}, etag, 1500000000.5)
+    assert not http_cache.is_modified({'If-None-Match': '"%s"' % (etag, )}, etag)
+    assert not http_cache.is_modified({'If-None-Match': 'W/"x", W/"%s"' % (etag, )}, etag)
+    assert http_cache.is_modified({'If-None-Match': '"x"'}, etag)
+    # If-None-Match takes precedence
+    headers = {'If-None-Match': '"x"', 'If-Modified-Since': 'Fri, 14 Jul 2017 02:40:00 GMT'}
+    assert http_cache.is_modified(headers, etag, 1500000000.5)
+    assert not http_cache.is_modified({'If-Modified-Since': 'Fri, 14 Jul 2017 02:40:00 GMT'}, etag, 1500000000.5)
+    assert http_cache.is_modified({'If-Modified-Since': 'Fri, 14 Jul 2017 02:39:59 GMT'}, etag, 1500000000.5)
+
+
+def test_window_policy():
+    config = {'HTTP_RECENT': 7200, 'HTTP_RECENT_MAX_AGE': 60, 'HTTP_IMMUTABLE_MAX_AGE': 86400}
+    now = datetime.datetime.now(datetime.timezone.utc)
+    assert http_cache.window_policy(None, config) == (60, False)
+    assert http_cache.window_policy(now - datetime.timedelta(hours=1), config) == (60, False)
+    assert http_cache.window_policy(datetime.datetime(2017, 1, 1), config) == (86400, True)
+    # the grid has data until the end of 2016
+    until = datetime.datetime(2016, 12, 31, 18, tzinfo=datetime.timezone.utc)
+    assert http_cache.window_policy(datetime.datetime(2017, 1, 1), config, until) == (60, False)
+    assert http_cache.window_policy(datetime.datetime(2016, 12, 1), config, until) == (86400, True)
+
+
+def test_conditional():
+    app = flask.Flask(__name__)
+    calls = []
+
+    def make_response():
+        calls.append(1)
+        return flask.Response(b'[1, 2]', mimetype='application/json')
+
+    with app.test_request_context('/'):
+        response = http_cache.conditional(make_response, etag='v1', last_modified=1500000000, max_age=3600)
+    assert response.status_code == 200
+    assert response.headers['ETag'] == '"v1"'
+    assert response.headers['Cache-Control'] == 'public, max-age=3600'
+    assert response.headers['Last-Modified'] == 'Fri, 14 Jul 2017 02:40:00 GMT'
+
+    with app.test_request_context('/', headers={'If-None-Match': '"v1"'}):
+        response = http_cache.conditional(make_response, etag='v1', max_age=3600)
+    assert response.status_code == 304
+    assert len(calls) == 1, "the response is not made for a current copy"
+
+    # the ETag of the body
+    with app.test_request_context('/'):
+        response = http_cache.conditional(make_response, max_age=60, vary='Accept')
+    etag = response.headers['ETag']
+    assert response.headers['Vary'] == 'Accept'
+    with app.test_request_context('/', headers={'If-None-Match': etag}):
+        response = http_cache.conditional(make_response, max_age=60, immutable=True)
+    assert response.status_code == 304
+    assert response.headers['Cache-Control'] == 'public, max-age=60, immutable'
+    assert not response.get_data()
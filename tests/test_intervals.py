@@ -0,0 +1,85 @@
+import datetime
+
+import pandas as pd
+
+from stathakis.measurements import intervals
+
+
+def test_subtract():
+    covered = intervals.merge([(5, 10), (0, 2), (9, 12)])
+    assert covered == [(0, 2), (5, 12)]
+    assert intervals.subtract(covered, 1, 20) == [(2, 5), (12, 20)]
+
+
+def test_split():
+    start_time = datetime.datetime(2017, 3, 10, 12, tzinfo=datetime.timezone.utc)
+    end_time = datetime.datetime(2017, 3, 13, tzinfo=datetime.timezone.utc)
+    periods = intervals.split(start_time, end_time, datetime.timedelta(days=1))
+    assert len(periods) == 3
+    assert periods[0] == (start_time, datetime.datetime(2017, 3, 11, tzinfo=datetime.timezone.utc))
+    assert periods[-1][1] == end_time
+
+
+def test_interval_cache():
+    cache = intervals.IntervalCache()
+    calls = []
+
+    def fetch(start, end):
+        calls.append((start, end))
+        times = pd.date_range(start, end, freq='10min')
+        return {"units": "cm", "data": pd.DataFrame({"value": range(len(times)), "dateTime": times})}
+
+    start_time = datetime.datetime(2017, 3, 10, tzinfo=datetime.timezone.utc)
+    end_time = datetime.datetime(2017, 3, 12, tzinfo=datetime.timezone.utc)
+    cache.get('HOEKVHLD', start_time, end_time, fetch)
+    # a sub range is served from the cache
+    series = cache.get('HOEKVHLD', start_time + datetime.timedelta(hours=1), end_time, fetch)
+    assert len(calls) == 1
+    assert len(series['data']) == 2 * 144 - 5
+
+
+def test_interval_cache_compact():
+    cache = intervals.IntervalCache(volatile=3600, volatile_expire=0)
+    calls = []
+
+    def fetch(start, end):
+        calls.append((start, end))
+        return {"data": pd.DataFrame({"value": [1.0], "dateTime": [start]})}
+
+    now = pd.Timestamp.now(tz='UTC')
+    start_time = now - pd.Timedelta(days=2)
+    end_time = now + pd.Timedelta(days=2)
+    # polled recent data is fetched again, it does not add coverage
+    for i in range(10):
+        cache.get('HOEKVHLD', start_time, end_time, fetch)
+    coverage = cache.entries['HOEKVHLD']['coverage']
+    assert len(calls) == 10
+    assert len(coverage) == 2
+    assert coverage[0][:2] == (start_time, coverage[1][0])
+    assert coverage[1][1] == end_time
+    # an older period is merged with the stable part
+    cache.get('HOEKVHLD', start_time - pd.Timedelta(days=1), start_time, fetch)
+    assert len(cache.entries['HOEKVHLD']['coverage']) == 2
+
+
+def test_interval_cache_idle(monkeypatch):
+    cache = intervals.IntervalCache(volatile=7200, volatile_expire=60)
+
+    def fetch(start, end):
+        return {"data": pd.DataFrame({"value": [1.0], "dateTime": [start]})}
+
+    fetched = 1500000000.0
+    monkeypatch.setattr(intervals.time, 'time', lambda: fetched)
+    now = pd.Timestamp(fetched, unit='s', tz='UTC')
+    start_time = now - pd.Timedelta(days=2)
+    end_time = now + pd.Timedelta(days=2)
+    cache.get('HOEKVHLD', start_time, end_time, fetch)
+    assert cache.missing('HOEKVHLD', start_time, end_time) == []
+    # after a while the data that was recent when it was fetched is fetched again
+    monkeypatch.setattr(intervals.time, 'time', lambda: fetched + 4 * 3600)
+    missing = cache.missing('HOEKVHLD', start_time, end_time)
+    assert missing == [(now - pd.Timedelta(hours=2), end_time)]
+    cache.get('HOEKVHLD', start_time, end_time, fetch)
+    coverage = cache.entries['HOEKVHLD']['coverage']
+    stable_until = now + pd.Timedelta(hours=2)
+    assert [interval[:2] for interval in coverage] == [(start_time, stable_until), (stable_until, end_time)]
@@ -1,6 +1,8 @@
 import pathlib
 
 import dateutil.parser
+import numpy as np
+import pandas as pd
 
 from stathakis.measurements import ncep
 
@@ -20,3 +22,77 @@ def test_get_measurement():
     quantity = 'wind'
     data = ncep.get_measurements(data_dir, quantity, lat, lon, start_time, end_time)
     assert set(data.keys()) == {'series'}, "we should have a series"
+
+
+def test_store():
+    data_dir = pathlib.Path('data/noaa/ncep')
+    store = ncep.get_store(data_dir)
+    assert ncep.get_store(data_dir) is store, "store should be shared"
+    assert len(store.t) == store.datasets['u'].variables['uwnd'].shape[0]
+
+
+def test_point_cache(tmpdir, monkeypatch):
+    start_time = dateutil.parser.parse("2010-3-10T09:00:00.000+01:00")
+    end_time = dateutil.parser.parse("2010-3-14T10:10:00.000+01:00")
+    # build the cache next to links to the grids, not in the data directory
+    data_dir = pathlib.Path(str(tmpdir))
+    for path in pathlib.Path('data/noaa/ncep').resolve().glob('*.nc'):
+        (data_dir / path.name).symlink_to(path)
+    # don't share the store of the copy with the other tests
+    monkeypatch.setattr(ncep, 'stores', {})
+    expected = ncep.get_measurements(data_dir, 'wind', 52, 3, start_time, end_time)
+    ncep.build_point_cache(data_dir)
+    store = ncep.get_store(data_dir)
+    store.refresh(force=True)
+    assert set(store.point_cache.keys()) == {'u', 'v'}
+    data = ncep.get_measurements(data_dir, 'wind', 52, 3, start_time, end_time)
+    assert data['series'].equals(expected['series']), "point cache should return the same series"
+
+
+def test_get_measurements_batch():
+    start_time = dateutil.parser.parse("2010-3-10T09:00:00.000+01:00")
+    end_time = dateutil.parser.parse("2010-3-14T10:10:00.000+01:00")
+    data_dir = pathlib.Path('data/noaa/ncep')
+    points = [[3, 52], [4, 53]]
+    data = ncep.get_measurements_batch(data_dir, 'wind', points, start_time, end_time)
+    assert len(data['points']) == 2, "we should have a series per point"
+    single = ncep.get_measurements(data_dir, 'wind', 53, 4, start_time, end_time)
+    assert data['points'][1]['series'].equals(single['series'])
+
+
+def test_get_bbox():
+    start_time = dateutil.parser.parse("2010-3-10T09:00:00.000+01:00")
+    end_time = dateutil.parser.parse("2010-3-14T10:10:00.000+01:00")
+    data_dir = pathlib.Path('data/noaa/ncep')
+    cube = ncep.get_bbox(data_dir, 'wind', 50, 55, 0, 5, start_time, end_time)
+    blocks = list(cube['blocks'])
+    n_times = sum(block['u'].shape[0] for _, block in blocks)
+    assert n_times == len(cube['time']), "blocks should cover the period"
+
+
+def test_grid_index():
+    # Gaussian latitudes run from north to south
+    lat = np.linspace(88.5, -88.5, 94)
+    lon = np.arange(192) * 1.875
+    index = ncep.GridIndex(lat, lon)
+    lat_idx, lon_idx = index.nearest([52, 52, 52], [3, -1, 359.5])
+    assert (lat_idx == np.argmin(np.abs(lat - 52))).all()
+    assert lon_idx.tolist() == [2, 191, 0], "longitudes should wrap around"
+    lat_idx, lon_idx, weights = index.weights([52], [-1])
+    assert np.isclose(weights.sum(), 1)
+    assert set(lon_idx[0]) == {191, 0}
+    lat_slice, lon_slices, lons = index.bbox(50, 55, -5, 5)
+    assert len(lon_slices) == 2, "box crosses the edge of the grid"
+    assert (np.diff(lons) > 0).all() and lons[0] >= -5 and lons[-1] <= 5
+
+
+def test_derive():
+    t = pd.date_range('2010-03-10', periods=8, freq='6h')
+    series = ncep.series_frame(t, np.array([0, 1] * 4, dtype='f4'), np.array([-1, 0] * 4, dtype='f4'))
+    derived = ncep.derive(series, variables=['speed', 'direction'])
+    assert list(derived.columns) == ['dateTime', 'speed', 'direction']
+    # wind from the north, wind from the west
+    assert np.allclose(derived['direction'][:2], [0, 270])
+    daily = ncep.derive(series, variables=['speed'], resample='daily', aggregate='max')
+    assert len(daily) == 2
+    assert np.allclose(daily['speed'], 1)
@@ -0,0 +1,55 @@
+import json
+import tempfile
+
+import netCDF4
+import numpy as np
+import pandas as pd
+
+from stathakis import responses
+
+
+def test_dumps():
+    df = pd.DataFrame({
+        'dateTime': pd.to_datetime(['2017-03-10T09:00:00+01:00', '2017-03-10T09:10:00+01:00'], utc=True),
+        'value': [1.5, np.nan]
+    })
+    data = {"series": [{"name": "water level", "data": df}]}
+    result = json.loads(responses.dumps(data).decode('utf-8'))
+    records = result['series'][0]['data']
+    assert records[0] == {"dateTime": "2017-03-10T08:00:00+00:00", "value": 1.5}
+    assert records[1]['value'] is None, "missing values should be null"
+    df.loc[1, 'dateTime'] = pd.NaT
+    records = json.loads(responses.dumps(data).decode('utf-8'))['series'][0]['data']
+    assert records[1]['dateTime'] is None, "missing times should be null"
+    assert responses.series_csv({"series": df}).decode('utf-8').splitlines()[2] == ','
+
+
+def test_series_formats():
+    df = pd.DataFrame({
+        'dateTime': pd.to_datetime(['2010-03-10T12:00:00', '2010-03-10T18:00:00']),
+        'u': [1.0, 2.0],
+        'v': [3.0, 4.0]
+    })
+    data = {"series": df}
+    columns = json.loads(responses.series_columns(data).decode('utf-8'))
+    assert columns['series']['u'] == [1.0, 2.0]
+    csv = responses.series_csv(data).decode('utf-8')
+    assert csv.splitlines()[1] == '2010-03-10T12:00:00,1.0,3.0'
+    assert df['dateTime'].dtype.kind == 'M', "encoding should not change the data"
+
+
+def test_series_table():
+    df = pd.DataFrame({
+        'value': [1.0, 2.0],
+        'dateTime': pd.to_datetime(['2017-03-10T09:00:00', '2017-03-10T09:10:00'], utc=True),
+        'status': ['Gecontroleerd', None],
+        'quality': [None, None]
+    })
+    data = {"series": [{"name": "water level", "units": "cm", "data": df}]}
+    empty = {"series": []}
+    assert responses.series_csv(empty).splitlines()[0] == responses.series_csv(data).splitlines()[0]
+    with tempfile.NamedTemporaryFile(suffix='.nc') as f:
+        f.write(responses.series_netcdf(data))
+        f.flush()
+        with netCDF4.Dataset(f.name) as ds:
+            assert list(ds.variables['status'][:]) == ['Gecontroleerd', '']
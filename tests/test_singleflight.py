@@ -0,0 +1,90 @@
+import asyncio
+import fcntl
+import threading
+import time
+
+from stathakis.singleflight import SingleFlight
+
+
+def test_do():
+    flights = SingleFlight()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        time.sleep(0.2)
+        return len(calls)
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(flights.do('key', fetch)))
+        for i in range(10)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [1] * 10
+    assert not flights.calls
+    # a new fetch after the first one is done
+    assert flights.do('key', fetch) == 2
+
+
+def test_do_async_exception(tmpdir):
+    flights = SingleFlight(str(tmpdir))
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.1)
+        raise ValueError('upstream failed')
+
+    async def fetch_all():
+        return await asyncio.gather(
+            *[flights.do_async('key', fetch, lock_key='key') for i in range(5)],
+            return_exceptions=True
+        )
+
+    results = asyncio.get_event_loop().run_until_complete(fetch_all())
+    assert len(calls) == 1
+    assert all(isinstance(result, ValueError) for result in results)
+    assert not flights.tasks
+
+
+def test_do_async_cancelled():
+    flights = SingleFlight()
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.1)
+        return 42
+
+    async def cancel_first():
+        first = asyncio.ensure_future(flights.do_async('key', fetch))
+        await asyncio.sleep(0.01)
+        others = [asyncio.ensure_future(flights.do_async('key', fetch)) for i in range(3)]
+        await asyncio.sleep(0.01)
+        # a client of the first request disconnected
+        first.cancel()
+        return await asyncio.gather(*others)
+
+    assert asyncio.get_event_loop().run_until_complete(cancel_first()) == [42] * 3
+    assert len(calls) == 1
+
+
+def test_do_async_lock(tmpdir):
+    flights = SingleFlight(str(tmpdir))
+    # held by another process (an other open file)
+    held = flights.lock_file('key')
+    fcntl.flock(held, fcntl.LOCK_EX)
+
+    async def fetch():
+        return 42
+
+    async def wait_for_lock():
+        loop = asyncio.get_event_loop()
+        loop.call_later(0.1, held.close)
+        return await asyncio.wait_for(flights.do_async('a', fetch, lock_key='key'), 5)
+
+    assert asyncio.get_event_loop().run_until_complete(wait_for_lock()) == 42
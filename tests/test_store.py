@@ -0,0 +1,40 @@
+import datetime
+
+import pandas as pd
+
+from stathakis.measurements.store import SeriesStore
+
+
+def fake_series(start, end):
+    times = pd.date_range(start, end, freq='10min')
+    return {
+        "name": "sea surface height",
+        "units": "cm",
+        "data": pd.DataFrame({"value": range(len(times)), "dateTime": times})
+    }
+
+
+def test_store(tmpdir):
+    store = SeriesStore(str(tmpdir.join('series.sqlite')))
+    key = ('HOEKVHLD', 'WATHTE')
+    calls = []
+
+    def fetch(start, end):
+        calls.append((start, end))
+        return fake_series(start, end)
+
+    start_time = datetime.datetime(2017, 3, 10, tzinfo=datetime.timezone.utc)
+    end_time = datetime.datetime(2017, 3, 12, tzinfo=datetime.timezone.utc)
+    series = store.get(key, start_time, end_time, fetch)
+    assert len(series['data']) == 2 * 144 + 1
+    # a sliding window only fetches the new part
+    series = store.get(key, start_time + datetime.timedelta(days=1), end_time + datetime.timedelta(days=1), fetch)
+    assert len(calls) == 2
+    assert calls[1] == (end_time, end_time + datetime.timedelta(days=1))
+    assert series['units'] == 'cm'
+
+
+def test_store_dir(tmpdir):
+    path = tmpdir.join('rws', 'series.sqlite')
+    SeriesStore(str(path))
+    assert path.check(file=1), "the directory of the store should be created"
@@ -0,0 +1,79 @@
+import asyncio
+import http.server
+import json
+import threading
+
+import pytest
+
+from stathakis.upstream import UpstreamClient
+
+
+class FlakyHandler(http.server.BaseHTTPRequestHandler):
+    """fail every first request, then answer"""
+    protocol_version = 'HTTP/1.1'
+    requests = []
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.requests.append(self.client_address)
+        if len(self.requests) == 1:
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = json.dumps({"Succesvol": True}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def url():
+    server = http.server.HTTPServer(('127.0.0.1', 0), FlakyHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield 'http://127.0.0.1:%d/' % (server.server_port, )
+    server.shutdown()
+
+
+def test_retry(url):
+    client = UpstreamClient(retries=2, backoff_factor=0)
+    assert client.post(url, json={}).json()['Succesvol']
+    assert client.post(url, json={}).json()['Succesvol']
+    assert len(FlakyHandler.requests) == 3, "first request should be retried"
+    assert len(set(FlakyHandler.requests)) == 1, "connection should be reused"
+
+
+def test_stream(url):
+    client = UpstreamClient(max_concurrent=1, retries=2, backoff_factor=0)
+    with client.stream(url, json={}) as resp:
+        assert not client.slots.acquire(blocking=False), "the body is read in the slot of the request"
+        assert json.loads(resp.raw.read().decode('utf-8'))['Succesvol']
+    assert client.slots.acquire(blocking=False)
+
+
+def test_async_retry(url):
+    pytest.importorskip('aiohttp')
+    from stathakis.aio import AsyncUpstreamClient
+
+    async def post_twice():
+        client = AsyncUpstreamClient(retries=2, backoff_factor=0)
+        await client.open()
+        try:
+            return [json.loads((await client.post(url, json={})).decode('utf-8')) for _ in range(2)]
+        finally:
+            await client.close()
+
+    del FlakyHandler.requests[:]
+    loop = asyncio.new_event_loop()
+    try:
+        responses = loop.run_until_complete(post_twice())
+    finally:
+        loop.close()
+    assert all(response['Succesvol'] for response in responses)
+    assert len(FlakyHandler.requests) == 3, "first request should be retried"